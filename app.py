@@ -1,16 +1,32 @@
 from flask import Flask, render_template, request, jsonify, send_from_directory, session, redirect, url_for
 from flask_socketio import SocketIO, emit, join_room, leave_room
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import re
-from urllib.parse import urlparse
+import codecs
+import queue
+from html.parser import HTMLParser
+from urllib.parse import urlparse, urlsplit, urlunsplit
 from datetime import datetime, timedelta
 import json
 import os
+import sys
 from threading import Lock
 import time
 from werkzeug.utils import secure_filename
 import hashlib
+import tempfile
+import atexit
+from bisect import bisect_left
+from collections import deque, OrderedDict, Counter
+from operator import itemgetter
+import heapq
+import math
+from itertools import islice
+import itertools
+from enum import IntEnum
+from abc import ABC, abstractmethod
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key-here-change-in-production'
@@ -18,29 +34,128 @@ app.config['MAX_CONTENT_LENGTH'] = 5 * 1024 * 1024 * 1024  # 5GB
 app.config['UPLOAD_FOLDER'] = 'uploads'
 socketio = SocketIO(app, cors_allowed_origins="*", max_http_buffer_size=5 * 1024 * 1024 * 1024)
 
+# 与 Socket.IO 异步模式（threading / eventlet / gevent）匹配的事件与队列；
+# 后台任务中的等待都使用它们或 socketio.sleep，协程模式下不会阻塞整个事件循环
+def create_event():
+    return socketio.server.eio.create_event()
+
+def create_queue(*args, **kwargs):
+    return socketio.server.eio.create_queue(*args, **kwargs)
+
+# 上传中的临时文件目录：与上传文件夹同级（同一文件系统，保证原子重命名），不会被孤立文件清理扫描到
+UPLOAD_TEMP_FOLDER = 'uploads_tmp'
+# 上传时每次读取与写入的块大小
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# 超过该时间（秒）未写入的临时文件视为中断的上传
+UPLOAD_TEMP_MAX_AGE = 3600
+
 # 创建上传文件夹
 if not os.path.exists(app.config['UPLOAD_FOLDER']):
     os.makedirs(app.config['UPLOAD_FOLDER'])
+os.makedirs(UPLOAD_TEMP_FOLDER, exist_ok=True)
+
+# 清理中断的上传留下的临时文件；只删除长时间未写入的文件，其他进程正在写入的上传不受影响
+def cleanup_stale_upload_temps():
+    cutoff = time.time() - UPLOAD_TEMP_MAX_AGE
+    for temp_name in os.listdir(UPLOAD_TEMP_FOLDER):
+        temp_path = os.path.join(UPLOAD_TEMP_FOLDER, temp_name)
+        try:
+            if os.path.getmtime(temp_path) < cutoff:
+                os.remove(temp_path)
+        except OSError:
+            pass
 
 # 允许的文件扩展名（可以根据需要调整）
 ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'doc', 'docx', 'xls', 'xlsx', 'ppt', 'pptx', 'zip', 'rar', '7z', 'mp3', 'mp4', 'avi', 'mkv', 'mov'}
 
 # 文件哈希映射表（hash -> unique_filename）
 file_hash_map = {}  # {hash: unique_filename}
-file_hash_lock = Lock()
+# 反向索引（unique_filename -> hash），与 file_hash_map 同步维护
+file_hash_by_name = {}  # {unique_filename: hash}
+file_hash_lock = Lock()  # 只保护映射表本身，持有期间不读写文件内容
 HASH_MAP_FILE = 'file_hash_map.json'
+# 哈希分段锁：相同内容的并发上传串行做去重判断，不同内容的上传互不阻塞
+# 加锁顺序：哈希分段锁 -> file_hash_lock
+FILE_HASH_LOCK_STRIPES = 64
+file_hash_locks = [Lock() for _ in range(FILE_HASH_LOCK_STRIPES)]
+
+def file_hash_guard(file_hash):
+    return file_hash_locks[int(file_hash[:8], 16) % FILE_HASH_LOCK_STRIPES]
+
+# 文件引用索引（unique_filename -> 引用该文件的房间集合），与各房间的 files 集合同步维护
+file_room_refs = {}  # {unique_filename: set(room_id)}
+# 文件大小（上传时记录，启动时对已引用文件统计一次）
+file_sizes = {}  # {unique_filename: bytes}
+file_refs_lock = Lock()
 
 # 加载文件哈希映射
 def load_hash_map():
-    global file_hash_map
+    global file_hash_map, file_hash_by_name
     if os.path.exists(HASH_MAP_FILE):
         try:
             with open(HASH_MAP_FILE, 'r', encoding='utf-8') as f:
                 file_hash_map = json.load(f)
+            file_hash_by_name = {name: file_hash for file_hash, name in file_hash_map.items()}
             print(f"已加载 {len(file_hash_map)} 个文件哈希映射")
         except Exception as e:
             print(f"加载哈希映射失败: {e}")
             file_hash_map = {}
+            file_hash_by_name = {}
+
+# 记录文件哈希（调用者持有 file_hash_lock）
+def set_file_hash(file_hash, unique_filename):
+    file_hash_map[file_hash] = unique_filename
+    file_hash_by_name[unique_filename] = file_hash
+
+# 按文件名移除哈希映射（调用者持有 file_hash_lock），返回是否存在映射
+def remove_file_hash(unique_filename):
+    file_hash = file_hash_by_name.pop(unique_filename, None)
+    if file_hash is None:
+        return False
+    if file_hash_map.get(file_hash) == unique_filename:
+        del file_hash_map[file_hash]
+    return True
+
+# 获取引用某文件的房间集合（副本）
+def get_file_refs(unique_filename):
+    with file_refs_lock:
+        return set(file_room_refs.get(unique_filename, ()))
+
+# 判断文件是否仍被任何房间引用
+def is_file_referenced(unique_filename):
+    with file_refs_lock:
+        return bool(file_room_refs.get(unique_filename))
+
+def _add_file_ref(unique_filename, room_id):
+    with file_refs_lock:
+        refs = file_room_refs.setdefault(unique_filename, set())
+        if not refs:
+            # 文件开始被引用，计入全局统计
+            adjust_global_stats(files=1, file_bytes=file_sizes.get(unique_filename, 0))
+        refs.add(room_id)
+
+def _remove_file_ref(unique_filename, room_id):
+    with file_refs_lock:
+        refs = file_room_refs.get(unique_filename)
+        if refs is not None and room_id in refs:
+            refs.discard(room_id)
+            if not refs:
+                del file_room_refs[unique_filename]
+                adjust_global_stats(files=-1, file_bytes=-file_sizes.get(unique_filename, 0))
+
+# 记录文件大小
+def record_file_size(unique_filename, size):
+    with file_refs_lock:
+        file_sizes[unique_filename] = size
+
+# 文件被物理删除后移除其大小记录
+def forget_file_size(unique_filename):
+    with file_refs_lock:
+        file_sizes.pop(unique_filename, None)
+
+def get_file_size(unique_filename):
+    with file_refs_lock:
+        return file_sizes.get(unique_filename, 0)
 
 # 保存文件哈希映射
 def save_hash_map():
@@ -50,14 +165,41 @@ def save_hash_map():
     except Exception as e:
         print(f"保存哈希映射失败: {e}")
 
-# 计算文件哈希值（使用SHA256）
-def calculate_file_hash(file_stream):
+# 单次读取上传流：边计算哈希（SHA256）边写入临时文件
+def save_upload_stream(file_stream):
+    """返回 (临时文件路径, 哈希, 字节数)；出错时删除临时文件"""
     sha256_hash = hashlib.sha256()
-    # 读取文件块计算哈希
-    for byte_block in iter(lambda: file_stream.read(4096), b""):
-        sha256_hash.update(byte_block)
-    file_stream.seek(0)  # 重置文件指针
-    return sha256_hash.hexdigest()
+    size = 0
+    fd, temp_path = tempfile.mkstemp(dir=UPLOAD_TEMP_FOLDER, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            for byte_block in iter(lambda: file_stream.read(UPLOAD_CHUNK_SIZE), b""):
+                sha256_hash.update(byte_block)
+                temp_file.write(byte_block)
+                size += len(byte_block)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return temp_path, sha256_hash.hexdigest(), size
+
+# 把上传完成的临时文件移动到上传文件夹，返回保存的文件名
+def publish_upload(temp_path, filename):
+    """先以独占方式创建目标文件占位，再原子地替换为临时文件
+
+    不同内容的上传可以并发完成，同名文件在同一毫秒内完成时换一个名字，不会覆盖已有文件。
+    """
+    timestamp = int(time.time() * 1000)
+    attempt = 0
+    while True:
+        unique_filename = f"{timestamp}_{filename}" if attempt == 0 else f"{timestamp}_{attempt}_{filename}"
+        filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
+        try:
+            os.close(os.open(filepath, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            attempt += 1
+            continue
+        os.replace(temp_path, filepath)
+        return unique_filename
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -186,6 +328,97 @@ def save_ai_provider():
         print(f"保存AI提供方失败: {e}")
         return False
 
+# HTTP 连接池：每个AI提供方与链接预览各用一个 Session，复用 keep-alive 连接，避免每次请求重新握手
+# 可在 ollama_config / third_party_ai_config 中覆盖以下参数
+HTTP_POOL_DEFAULTS = {
+    'pool_size': 10,  # 每个主机保持的连接数
+    'max_retries': 2,  # 连接失败重试次数（GET 请求还会重试 502/503/504）
+    'connect_timeout': 3.0,  # 建立连接超时（秒）
+    'read_timeout': 60.0  # 两次读取之间的超时（秒），模型首次加载可能较慢
+}
+# 链接预览使用独立的连接池
+LINK_PREVIEW_HTTP_SETTINGS = {
+    'pool_size': 4,
+    'max_retries': 1,
+    'connect_timeout': 3.0,
+    'read_timeout': 3.0
+}
+http_sessions = {}  # {name: (settings, requests.Session)}
+http_sessions_lock = Lock()
+
+def parse_config_bool(value):
+    """解析布尔配置项，只接受 true/false/1/0（bool("false") 为真，不能直接转换）"""
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)) and value in (0, 1):
+        return bool(value)
+    if isinstance(value, str) and value.strip().lower() in ('true', '1', 'false', '0'):
+        return value.strip().lower() in ('true', '1')
+    raise ValueError(f"无效的布尔值: {value!r}（应为 true/false/1/0）")
+
+def coerce_config_value(value, default):
+    """按默认值的类型转换配置项"""
+    if isinstance(default, bool):
+        return parse_config_bool(value)
+    return type(default)(value)
+
+def config_settings(config, defaults):
+    """从提供方配置中读取一组参数，缺省或无效时使用默认值"""
+    settings = {}
+    for key, default in defaults.items():
+        try:
+            settings[key] = coerce_config_value(config.get(key, default), default)
+        except (TypeError, ValueError):
+            settings[key] = default
+    return settings
+
+def http_pool_settings(config):
+    """从提供方配置中读取连接池参数"""
+    return config_settings(config, HTTP_POOL_DEFAULTS)
+
+def http_timeout(settings):
+    """(连接超时, 读取超时)"""
+    return (settings['connect_timeout'], settings['read_timeout'])
+
+def _build_http_session(settings):
+    retries = max(0, settings['max_retries'])
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=0,
+        status=retries,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset({'GET', 'HEAD'}),  # POST 只在连接失败时重试
+        backoff_factor=0.3,
+        raise_on_status=False
+    )
+    pool_size = max(1, settings['pool_size'])
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    http_session = requests.Session()
+    http_session.mount('http://', adapter)
+    http_session.mount('https://', adapter)
+    return http_session
+
+# 获取（必要时创建）指定名称的 Session
+def get_http_session(name, settings):
+    with http_sessions_lock:
+        entry = http_sessions.get(name)
+        if entry is not None and entry[0] == settings:
+            return entry[1]
+        http_session = _build_http_session(settings)
+        http_sessions[name] = (dict(settings), http_session)
+    if entry is not None:
+        entry[1].close()
+    return http_session
+
+# 配置变更后丢弃旧的 Session，下次请求时按新配置重建
+def reset_http_session(name):
+    with http_sessions_lock:
+        entry = http_sessions.pop(name, None)
+    if entry is not None:
+        entry[1].close()
+
+
 # 加载管理员凭据
 def load_admin_credentials():
     global admin_credentials
@@ -226,131 +459,856 @@ def save_config():
     except Exception as e:
         print(f"保存网站配置失败: {e}")
 
+# 消息时间格式（对外的消息字典使用该格式，内存中只保存整数时间戳）
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# 消息类型
+class MessageType(IntEnum):
+    USER = 0
+    SYSTEM = 1
+    AI = 2
+    FILE = 3
+
+MESSAGE_TYPE_NAMES = {message_type: message_type.name.lower() for message_type in MessageType}
+MESSAGE_TYPES_BY_NAME = {name: message_type for message_type, name in MESSAGE_TYPE_NAMES.items()}
+# 进入AI上下文的消息类型
+AI_CONTEXT_TYPES = (MessageType.USER, MessageType.AI)
+
+def parse_timestamp(value):
+    """将消息字典中的时间字符串转换为整数时间戳，无法解析时使用当前时间"""
+    if isinstance(value, (int, float)):
+        return int(value)
+    try:
+        return int(time.mktime(time.strptime(value, TIMESTAMP_FORMAT)))
+    except (TypeError, ValueError):
+        return int(time.time())
+
+# 文件消息附带的文件信息
+class FileInfo:
+    """紧凑的文件信息；original_filename 与 download_url 可由其余字段推导，不单独保存"""
+    __slots__ = ('filename', 'unique_filename', 'size', 'file_type', 'is_cached')
+
+    def __init__(self, filename, unique_filename, size, file_type, is_cached=False):
+        self.filename = filename
+        self.unique_filename = unique_filename
+        self.size = size
+        self.file_type = sys.intern(file_type or 'other')
+        self.is_cached = bool(is_cached)
+
+    def to_dict(self):
+        return {
+            'filename': self.filename,
+            'original_filename': self.filename,
+            'unique_filename': self.unique_filename,
+            'size': self.size,
+            'download_url': f'/download/{self.unique_filename}',
+            'file_type': self.file_type,
+            'is_cached': self.is_cached
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            data.get('original_filename') or data.get('filename') or '',
+            data.get('unique_filename') or '',
+            data.get('size') or '',
+            data.get('file_type'),
+            data.get('is_cached', False)
+        )
+
+# 房间历史中的一条消息
+class ChatMessage:
+    """紧凑的消息记录
+
+    房间历史中每条消息都常驻内存，因此使用 __slots__ 而非字典：用户名驻留（intern）共享，
+    类型为枚举，时间为整数时间戳。仅在发送给客户端或写入日志时通过 to_dict 转换为消息字典。
+    """
+    __slots__ = ('seq', 'type', 'username', 'text', 'timestamp', 'message_id', 'link_previews', 'file_info')
+
+    def __init__(self, message_type, username, text, timestamp=None, message_id=None,
+                 link_previews=None, file_info=None, seq=None):
+        self.seq = seq
+        self.type = message_type
+        self.username = sys.intern(username or '')
+        self.text = text or ''
+        self.timestamp = int(time.time()) if timestamp is None else timestamp
+        self.message_id = message_id
+        self.link_previews = link_previews  # 按链接在消息中的顺序排列，未获取到的位置为 None
+        self.file_info = file_info
+
+    @property
+    def type_name(self):
+        return MESSAGE_TYPE_NAMES[self.type]
+
+    @property
+    def link_preview(self):
+        """第一个可用的链接预览（兼容只显示单个预览的客户端）"""
+        for preview in self.link_previews or ():
+            if preview is not None:
+                return preview
+        return None
+
+    def set_link_preview(self, index, preview):
+        if self.link_previews is None:
+            self.link_previews = []
+        if len(self.link_previews) <= index:
+            self.link_previews.extend([None] * (index + 1 - len(self.link_previews)))
+        self.link_previews[index] = preview
+
+    def to_dict(self):
+        """转换为客户端与日志使用的消息字典"""
+        data = {
+            'username': self.username,
+            'message': self.text,
+            'type': MESSAGE_TYPE_NAMES[self.type],
+            'timestamp': time.strftime(TIMESTAMP_FORMAT, time.localtime(self.timestamp))
+        }
+        if self.type == MessageType.USER:
+            data['link_preview'] = self.link_preview
+            if self.link_previews and len(self.link_previews) > 1:
+                data['link_previews'] = list(self.link_previews)
+        if self.file_info is not None:
+            data['file_info'] = self.file_info.to_dict()
+        if self.message_id is not None:
+            data['message_id'] = self.message_id
+        if self.seq is not None:
+            data['seq'] = self.seq
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        """从消息字典（日志、旧版历史文件）构建消息"""
+        file_info = data.get('file_info')
+        link_previews = data.get('link_previews')
+        if link_previews is None and data.get('link_preview'):
+            link_previews = [data['link_preview']]
+        return cls(
+            MESSAGE_TYPES_BY_NAME.get(data.get('type'), MessageType.USER),
+            data.get('username'),
+            data.get('message'),
+            timestamp=parse_timestamp(data.get('timestamp')),
+            message_id=data.get('message_id'),
+            link_previews=link_previews,
+            file_info=FileInfo.from_dict(file_info) if file_info else None,
+            seq=data.get('seq')
+        )
+
 # 存储房间信息
 rooms = {}
 # 存储房间成员及其加入时间
 room_members = {}  # {room_id: {username: join_timestamp}}
 # 存储房间历史消息和最后活跃时间
-room_history = {}  # {room_id: {'messages': [], 'last_active': datetime, 'users': set(), 'files': set()}}
-history_lock = Lock()
+room_history = {}  # {room_id: {'messages': deque(ChatMessage), 'last_active': datetime, 'users': set(), 'files': set()}}
+# 房间注册表锁：保护 room_history 字典本身（创建/删除房间、遍历所有房间）
+room_registry_lock = Lock()
+# 房间分段锁：按房间ID散列到固定数量的锁上，保护单个房间的数据
+# 加锁顺序：room_registry_lock -> 房间分段锁 -> 哈希分段锁 -> file_hash_lock -> persist_lock
+ROOM_LOCK_STRIPES = 64
+room_locks = [Lock() for _ in range(ROOM_LOCK_STRIPES)]
+
+def room_lock(room_id):
+    return room_locks[hash(room_id) % ROOM_LOCK_STRIPES]
+
+# 获取所有房间的一致性快照
+def snapshot_rooms(extract):
+    """短暂持有注册表锁与全部分段锁，对每个房间调用 extract(room_id, room_data) 复制所需字段
+
+    返回复制结果列表；调用者在锁外构建响应，避免长时间阻塞房间。
+    """
+    with room_registry_lock:
+        items = list(room_history.items())
+        for lock in room_locks:
+            lock.acquire()
+        try:
+            return [extract(room_id, room_data) for room_id, room_data in items]
+        finally:
+            for lock in room_locks:
+                lock.release()
+
+# 全局聚合统计：随事件增量维护，管理接口读取时无需遍历消息或访问文件系统
+aggregate_lock = Lock()  # 叶子锁，持有期间不获取其他锁
+global_stats = {
+    'messages_by_type': {},  # {type: count}
+    'files': 0,  # 被引用的不同文件数
+    'file_bytes': 0,  # 被引用文件的总大小
+    'online_users': 0
+}
+
+def adjust_global_stats(files=0, file_bytes=0, online_users=0, message_type=None, messages=0):
+    with aggregate_lock:
+        global_stats['files'] += files
+        global_stats['file_bytes'] += file_bytes
+        global_stats['online_users'] += online_users
+        if message_type is not None:
+            by_type = global_stats['messages_by_type']
+            by_type[message_type] = by_type.get(message_type, 0) + messages
+            if by_type[message_type] <= 0:
+                del by_type[message_type]
+
+def get_global_stats():
+    with aggregate_lock:
+        return {
+            'messages_by_type': dict(global_stats['messages_by_type']),
+            'total_messages': sum(global_stats['messages_by_type'].values()),
+            'files': global_stats['files'],
+            'file_bytes': global_stats['file_bytes'],
+            'online_users': global_stats['online_users']
+        }
+
+# 统计一条消息的增减（调用者持有该房间的分段锁）
+def count_room_message(room_data, message, delta):
+    message_type = message.type_name
+    by_type = room_data['stats']['by_type']
+    by_type[message_type] = by_type.get(message_type, 0) + delta
+    if by_type[message_type] <= 0:
+        del by_type[message_type]
+    adjust_global_stats(message_type=message_type, messages=delta)
 
 # AI 请求统计（全局）
 ai_stats_lock = Lock()
 ai_request_total = 0
 ai_request_success = 0
+# 最近请求的提示 token 估算（用于调整上下文预算）
+ai_prompt_tokens = deque(maxlen=100)
+ai_prompt_stats = {'requests': 0, 'truncated_messages': 0, 'dropped_messages': 0}
 
-# 历史记录文件路径
+# 旧版历史记录文件路径（仅用于迁移）
 HISTORY_FILE = 'room_history.json'
 
-# 加载历史记录
-def load_history():
-    global room_history
-    if os.path.exists(HISTORY_FILE):
+# 房间消息日志目录：每个房间一个追加写日志（JSON Lines）
+# 日志首行为房间快照，其后每行是一条增量记录：
+#   msg        追加一条消息
+#   preview    更新某条消息的链接预览
+#   file_add   房间关联文件
+#   file_remove 房间取消关联文件
+#   touch      更新最后活跃时间
+ROOM_LOG_DIR = 'room_logs'
+# 单个房间日志的记录数超过该值时压缩为快照
+ROOM_LOG_COMPACT_THRESHOLD = 2000
+# 每个房间默认最多保留的消息数（房间消息存放在定长环形缓冲区中，可按房间单独调整）
+MAX_ROOM_MESSAGES = 1000
+# 单个房间容量的允许范围
+MIN_ROOM_CAPACITY = 50
+MAX_ROOM_CAPACITY = 10000
+# 每个房间保留的最近用户/AI消息条数（AI上下文窗口）
+AI_CONTEXT_MAX_ITEMS = 20
+room_log_counts = {}  # {room_id: 日志中的记录数}
+
+if not os.path.exists(ROOM_LOG_DIR):
+    os.makedirs(ROOM_LOG_DIR)
+
+def room_log_path(room_id):
+    """房间ID可能包含任意字符，使用摘要作为日志文件名"""
+    digest = hashlib.md5(room_id.encode('utf-8')).hexdigest()
+    return os.path.join(ROOM_LOG_DIR, f'{digest}.log')
+
+def _encode_log_value(value):
+    # 消息在内存中以 ChatMessage 保存，写盘时才转换为字典
+    if isinstance(value, ChatMessage):
+        return value.to_dict()
+    raise TypeError(f'无法序列化 {type(value).__name__}')
+
+def _dump_log_record(record):
+    return json.dumps(record, ensure_ascii=False, separators=(',', ':'), default=_encode_log_value) + '\n'
+
+def _new_room_data(last_active=None, capacity=MAX_ROOM_MESSAGES):
+    return {
+        # 定长环形缓冲区：超过容量时自动淘汰最旧的消息
+        'messages': deque(maxlen=capacity),
+        'last_active': last_active or datetime.now(),
+        'users': set(),
+        'files': set(),
+        # 房间聚合统计：按类型的消息数与关联文件总大小
+        'stats': {'by_type': {}, 'file_bytes': 0},
+        # 消息序号：房间内单调递增，作为历史分页游标
+        'next_seq': 0,
+        # 二级索引：按文件类型记录消息序号（升序），筛选分页时无需扫描
+        'type_index': {},
+        # 最近的用户/AI消息，随消息追加增量维护，构建AI上下文时无需扫描全部历史
+        'ai_context': deque(maxlen=AI_CONTEXT_MAX_ITEMS),
+        # 更早对话的滚动摘要：{'text', 'through_seq', 'updated_at'}
+        'summary': None,
+        # 用户/AI消息的检索索引，与环形缓冲区同步淘汰
+        'search_index': RoomSearchIndex()
+    }
+
+# 后台持久化（write-behind）：热路径只把记录放入内存队列，由后台线程合并写盘
+# 刷盘间隔（秒）
+PERSIST_FLUSH_INTERVAL = 2.0
+# 待写记录数达到该值时立即唤醒后台线程
+PERSIST_FLUSH_THRESHOLD = 200
+persist_lock = Lock()  # 保护以下待写状态，持有时间极短
+pending_log_records = {}  # {room_id: [record, ...]} 待追加的日志记录（脏房间）
+pending_record_count = 0
+pending_compactions = set()  # 待重写快照的房间（新房间、已删除房间、日志过长）
+persist_wakeup = create_event()
+flush_lock = Lock()  # 保证同一时间只有一个刷盘过程
+persist_status = {
+    'last_flush': None,
+    'last_flush_records': 0,
+    'last_flush_ms': 0.0,
+    'flush_count': 0
+}
+
+# 追加一条记录到房间日志
+def append_room_log(room_id, record):
+    """将记录加入待写队列并标记房间为脏（调用者持有该房间的分段锁）"""
+    global pending_record_count
+    with persist_lock:
+        pending_log_records.setdefault(room_id, []).append(record)
+        pending_record_count += 1
+        if pending_record_count >= PERSIST_FLUSH_THRESHOLD:
+            persist_wakeup.set()
+
+# 请求压缩房间日志
+def compact_room_log(room_id):
+    """请求用房间当前状态重写日志；房间已不存在时删除日志（调用者持有该房间的分段锁）
+
+    快照在刷盘时生成，已包含尚未写入的记录，因此直接丢弃它们。
+    """
+    global pending_record_count
+    with persist_lock:
+        dropped = pending_log_records.pop(room_id, None)
+        if dropped:
+            pending_record_count -= len(dropped)
+        pending_compactions.add(room_id)
+    persist_wakeup.set()
+
+# 写入房间快照
+def _write_room_snapshot(room_id):
+    global pending_record_count
+    path = room_log_path(room_id)
+    with room_lock(room_id):
+        room_data = room_history.get(room_id)
+        snapshot = None
+        if room_data is not None:
+            snapshot = {
+                'op': 'snapshot',
+                'room': room_id,
+                'last_active': room_data['last_active'].isoformat(),
+                'capacity': room_data['messages'].maxlen,
+                'next_seq': room_data['next_seq'],
+                'files': list(room_data.get('files', set())),
+                'summary': room_data['summary'],
+                'messages': list(room_data['messages'])
+            }
+        # 快照之前入队的记录都已体现在快照中
+        with persist_lock:
+            dropped = pending_log_records.pop(room_id, None)
+            if dropped:
+                pending_record_count -= len(dropped)
+    if snapshot is None:
+        if os.path.exists(path):
+            os.remove(path)
+        room_log_counts.pop(room_id, None)
+        return
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(_dump_log_record(snapshot))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    room_log_counts[room_id] = 1
+
+# 将待写记录刷入房间日志
+def flush_room_logs():
+    """合并写入所有脏房间的日志，并执行待处理的压缩"""
+    global pending_log_records, pending_record_count, pending_compactions
+    with flush_lock:
+        started = time.time()
+        with persist_lock:
+            batch = pending_log_records
+            compactions = pending_compactions
+            pending_log_records = {}
+            pending_compactions = set()
+            pending_record_count = 0
+        written = 0
+        for room_id, records in batch.items():
+            if room_id in compactions:
+                continue
+            path = room_log_path(room_id)
+            if not os.path.exists(path):
+                compactions.add(room_id)
+                continue
+            try:
+                with open(path, 'a', encoding='utf-8') as f:
+                    f.write(''.join(_dump_log_record(r) for r in records))
+                written += len(records)
+                room_log_counts[room_id] = room_log_counts.get(room_id, 0) + len(records)
+                if room_log_counts[room_id] > ROOM_LOG_COMPACT_THRESHOLD:
+                    compactions.add(room_id)
+            except Exception as e:
+                print(f"写入房间日志失败 {room_id}: {e}")
+        for room_id in compactions:
+            try:
+                _write_room_snapshot(room_id)
+                written += 1
+            except Exception as e:
+                print(f"压缩房间日志失败 {room_id}: {e}")
+                import traceback
+                traceback.print_exc()
+        if written:
+            persist_status['last_flush'] = datetime.now()
+            persist_status['last_flush_records'] = written
+            persist_status['last_flush_ms'] = (time.time() - started) * 1000
+            persist_status['flush_count'] += 1
+
+# 后台持久化线程
+def persistence_worker():
+    while True:
+        persist_wakeup.wait(PERSIST_FLUSH_INTERVAL)
+        persist_wakeup.clear()
         try:
-            with open(HISTORY_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                # 转换日期字符串为datetime对象
-                for room_id, room_data in data.items():
-                    room_history[room_id] = {
-                        'messages': room_data['messages'],
-                        'last_active': datetime.fromisoformat(room_data['last_active']),
-                        'users': set(),
-                        'files': set(room_data.get('files', []))  # 兼容旧数据
-                    }
-                print(f"已加载 {len(room_history)} 个房间的历史记录")
+            flush_room_logs()
         except Exception as e:
-            print(f"加载历史记录失败: {e}")
-            room_history = {}
+            print(f"后台持久化失败: {e}")
+
+def get_persist_status():
+    with persist_lock:
+        pending_rooms = len(set(pending_log_records) | pending_compactions)
+        pending_records = pending_record_count
+    last_flush = persist_status['last_flush']
+    return {
+        'last_flush': last_flush.strftime('%Y-%m-%d %H:%M:%S') if last_flush else None,
+        'last_flush_records': persist_status['last_flush_records'],
+        'last_flush_ms': round(persist_status['last_flush_ms'], 1),
+        'flush_count': persist_status['flush_count'],
+        'pending_dirty_rooms': pending_rooms,
+        'pending_records': pending_records
+    }
+
+# 重放单个房间日志
+def replay_room_log(path):
+    """返回 (room_id, room_data, 记录数)；日志无效时返回 None"""
+    room_id = None
+    room_data = None
+    count = 0
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # 进程崩溃可能留下写了一半的末行，忽略即可
+                continue
+            count += 1
+            op = record.get('op')
+            if op == 'snapshot':
+                room_id = record['room']
+                room_data = _new_room_data(
+                    datetime.fromisoformat(record['last_active']),
+                    record.get('capacity', MAX_ROOM_MESSAGES)
+                )
+                room_data['messages'].extend(ChatMessage.from_dict(m) for m in record.get('messages', []))
+                room_data['files'] = set(record.get('files', []))
+                room_data['next_seq'] = record.get('next_seq', 0)
+                room_data['summary'] = record.get('summary')
+                continue
+            if room_data is None:
+                continue
+            if 'at' in record:
+                room_data['last_active'] = datetime.fromisoformat(record['at'])
+            if op == 'msg':
+                room_data['messages'].append(ChatMessage.from_dict(record['msg']))
+            elif op == 'preview':
+                msg = find_room_message(room_data, record['id'])
+                if msg is not None:
+                    msg.set_link_preview(record.get('index', 0), record['link_preview'])
+            elif op == 'file_add':
+                room_data['files'].add(record['name'])
+            elif op == 'file_remove':
+                room_data['files'].discard(record['name'])
+            elif op == 'summary':
+                room_data['summary'] = record['summary']
+    if room_id is None:
+        return None
+    return room_id, room_data, count
 
-# 保存历史记录
-def save_history():
+# 加载历史记录
+def load_history():
+    global room_history
     try:
-        # 不使用lock,因为调用者已经持有锁
-        data = {}
-        for room_id, room_data in room_history.items():
-            data[room_id] = {
-                'messages': room_data['messages'],
-                'last_active': room_data['last_active'].isoformat(),
-                'files': list(room_data.get('files', set()))  # 保存文件列表
-            }
-        with open(HISTORY_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        print(f"已保存 {len(data)} 个房间的历史记录")
+        log_files = [name for name in os.listdir(ROOM_LOG_DIR) if name.endswith('.log')]
+        if not log_files and os.path.exists(HISTORY_FILE):
+            migrate_legacy_history()
+            return
+        for name in log_files:
+            path = os.path.join(ROOM_LOG_DIR, name)
+            try:
+                result = replay_room_log(path)
+            except Exception as e:
+                print(f"重放房间日志失败 {name}: {e}")
+                continue
+            if result:
+                room_id, room_data, count = result
+                room_history[room_id] = room_data
+                room_log_counts[room_id] = count
+        print(f"已加载 {len(room_history)} 个房间的历史记录")
     except Exception as e:
-        print(f"保存历史记录失败: {e}")
-        import traceback
-        traceback.print_exc()
+        print(f"加载历史记录失败: {e}")
+        room_history = {}
 
-# 清理过期的房间历史
-def cleanup_expired_rooms():
-    with history_lock:
-        now = datetime.now()
-        expired_rooms = []
-        
+# 将旧版 room_history.json 迁移为房间日志
+def migrate_legacy_history():
+    with open(HISTORY_FILE, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    for room_id, room_data in data.items():
+        room_history[room_id] = _new_room_data(datetime.fromisoformat(room_data['last_active']))
+        room_history[room_id]['messages'].extend(ChatMessage.from_dict(m) for m in room_data['messages'])
+        room_history[room_id]['files'] = set(room_data.get('files', []))  # 兼容旧数据
+        compact_room_log(room_id)
+    flush_room_logs()
+    os.replace(HISTORY_FILE, HISTORY_FILE + '.migrated')
+    print(f"已将 {len(room_history)} 个房间的历史记录迁移到 {ROOM_LOG_DIR}/")
+
+# 历史分页：每页默认条数与上限
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+
+def _message_index_keys(message):
+    """消息所属的二级索引：file 包含所有文件消息，image/video 按文件类型"""
+    file_info = message.file_info
+    if file_info is None:
+        return ()
+    file_type = file_info.file_type
+    if file_type in ('image', 'video'):
+        return ('file', file_type)
+    return ('file',)
+
+# 为消息分配序号并加入二级索引（调用者持有该房间的分段锁）
+def index_room_message(room_data, message):
+    seq = room_data['next_seq']
+    message.seq = seq
+    room_data['next_seq'] = seq + 1
+    for key in _message_index_keys(message):
+        room_data['type_index'].setdefault(key, deque()).append(seq)
+
+# 重建单个房间的消息序号与二级索引，返回序号是否被重新分配
+def rebuild_room_message_index(room_data):
+    messages = room_data['messages']
+    renumbered = False
+    if messages:
+        first_seq = messages[0].seq
+        contiguous = isinstance(first_seq, int) and all(
+            message.seq == first_seq + i for i, message in enumerate(messages)
+        )
+        if not contiguous:
+            # 旧数据没有序号：按顺序重新编号
+            base = room_data.get('next_seq', 0)
+            for i, message in enumerate(messages):
+                message.seq = base + i
+            renumbered = True
+        room_data['next_seq'] = max(room_data.get('next_seq', 0), messages[-1].seq + 1)
+    room_data['type_index'] = {}
+    for message in messages:
+        for key in _message_index_keys(message):
+            room_data['type_index'].setdefault(key, deque()).append(message.seq)
+    room_data['ai_context'] = deque(
+        (message for message in messages if message.type in AI_CONTEXT_TYPES),
+        maxlen=AI_CONTEXT_MAX_ITEMS
+    )
+    room_data['search_index'] = RoomSearchIndex()
+    for message in messages:
+        if message.type in AI_CONTEXT_TYPES:
+            room_data['search_index'].add(message)
+    return renumbered
+
+# 按游标分页读取房间历史（调用者持有该房间的分段锁）
+def get_room_history_page(room_data, filter_type, before=None, after=None, limit=HISTORY_PAGE_SIZE):
+    """返回 (messages, has_more_before, has_more_after)
+
+    无游标时返回最新一页；before 返回序号小于 before 的最近 limit 条；
+    after 返回序号大于 after 的最早 limit 条。结果按时间正序排列。
+    """
+    messages = room_data['messages']
+    if not messages:
+        return [], False, False
+    first_seq = messages[0].seq
+    if filter_type == 'all':
+        seqs = range(first_seq, first_seq + len(messages))
+    else:
+        seqs = room_data['type_index'].get(filter_type, ())
+    lo = 0 if after is None else bisect_left(seqs, after + 1)
+    hi = len(seqs) if before is None else bisect_left(seqs, before)
+    # 跳过已被裁剪的旧消息
+    lo = max(lo, bisect_left(seqs, first_seq))
+    if hi <= lo:
+        return [], False, False
+    if after is not None and before is None:
+        start, end = lo, min(hi, lo + limit)
+    else:
+        start, end = max(lo, hi - limit), hi
+    page = [messages[seqs[i] - first_seq] for i in range(start, end)]
+    return page, start > bisect_left(seqs, first_seq), end < len(seqs)
+
+# 按消息ID查找房间内的消息（从最新的开始查找）
+def find_room_message(room_data, message_id):
+    for message in reversed(room_data['messages']):
+        if message.message_id == message_id:
+            return message
+    return None
+
+# 房间历史检索：每个房间一个增量维护的 BM25 倒排索引，覆盖环形缓冲区中的用户/AI消息，
+# 条数随房间容量变化，重启后按保留的历史重建
+# 英文与数字按单词切分；中日韩文字按相邻两字（bigram）切分
+SEARCH_TERM_RE = re.compile(r'[a-z0-9_]+|[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff]+')
+
+def search_terms(text):
+    terms = []
+    for run in SEARCH_TERM_RE.findall(text.lower()):
+        if run[0] < '\u2e80' or len(run) == 1:
+            terms.append(run)
+        else:
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return terms
+
+class RoomSearchIndex:
+    """BM25 倒排索引，文档按消息序号标识（调用者持有该房间的分段锁）
+
+    只保存 (角色, 昵称, 时间戳, 文本, 文档长度)，不引用消息对象；
+    词频不单独保存，移除文档时重新切分文本。
+    """
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self):
+        self.docs = {}  # {seq: (role, username, timestamp, text, 文档长度)}
+        self.postings = {}  # {term: {seq: tf}}
+        self.total_length = 0
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add(self, message):
+        terms = search_terms(message.text)
+        if not terms:
+            return
+        role = 'assistant' if message.type == MessageType.AI else 'user'
+        self.docs[message.seq] = (role, message.username, message.timestamp, message.text, len(terms))
+        for term, count in Counter(terms).items():
+            self.postings.setdefault(term, {})[message.seq] = count
+        self.total_length += len(terms)
+
+    def discard(self, seq):
+        doc = self.docs.pop(seq, None)
+        if doc is None:
+            return
+        for term in set(search_terms(doc[3])):
+            posting = self.postings[term]
+            del posting[seq]
+            if not posting:
+                del self.postings[term]
+        self.total_length -= doc[4]
+
+    def search(self, query, k, before_seq=None):
+        """返回与 query 最相关的 k 条 (角色, 昵称, 时间戳, 文本)（按时间正序）；before_seq 之后的消息不参与"""
+        terms = set(search_terms(query))
+        if not terms or not self.docs or k <= 0:
+            return []
+        doc_count = len(self.docs)
+        avg_length = self.total_length / doc_count
+        scores = {}
+        for term in terms:
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (doc_count - len(posting) + 0.5) / (len(posting) + 0.5))
+            for seq, tf in posting.items():
+                if before_seq is not None and seq >= before_seq:
+                    continue
+                length = self.docs[seq][4]
+                norm = tf + self.K1 * (1 - self.B + self.B * length / avg_length)
+                scores[seq] = scores.get(seq, 0.0) + idf * tf * (self.K1 + 1) / norm
+        best = heapq.nlargest(k, scores.items(), key=itemgetter(1))
+        return [self.docs[seq][:4] for seq, _ in sorted(best)]
+
+# 追加消息到房间历史
+def append_room_message(room_id, message):
+    """追加消息并写入房间日志（调用者持有该房间的分段锁）"""
+    room_data = room_history[room_id]
+    messages = room_data['messages']
+    if len(messages) == messages.maxlen:
+        # 缓冲区已满：淘汰最旧的一条（O(1)）
+        evict_oldest_message(room_data)
+    index_room_message(room_data, message)
+    messages.append(message)
+    if message.type in AI_CONTEXT_TYPES:
+        room_data['ai_context'].append(message)
+        room_data['search_index'].add(message)
+    count_room_message(room_data, message, 1)
+    room_data['last_active'] = datetime.now()
+    append_room_log(room_id, {
+        'op': 'msg',
+        'at': room_data['last_active'].isoformat(),
+        'msg': message
+    })
+
+# 淘汰房间最旧的一条消息，同步更新统计与二级索引（调用者持有该房间的分段锁）
+def evict_oldest_message(room_data):
+    message = room_data['messages'].popleft()
+    count_room_message(room_data, message, -1)
+    for key in _message_index_keys(message):
+        seqs = room_data['type_index'].get(key)
+        if seqs and seqs[0] == message.seq:
+            seqs.popleft()
+    ai_context = room_data['ai_context']
+    if ai_context and ai_context[0] is message:
+        ai_context.popleft()
+    room_data['search_index'].discard(message.seq)
+
+# 调整房间容量（调用者持有该房间的分段锁）
+def set_room_capacity(room_id, capacity):
+    room_data = room_history[room_id]
+    while len(room_data['messages']) > capacity:
+        evict_oldest_message(room_data)
+    room_data['messages'] = deque(room_data['messages'], maxlen=capacity)
+    # 容量保存在快照中
+    compact_room_log(room_id)
+
+# 用户进入/离开房间（调用者持有该房间的分段锁）
+def add_room_user(room_id, username):
+    users = room_history[room_id]['users']
+    if username not in users:
+        users.add(username)
+        adjust_global_stats(online_users=1)
+
+def remove_room_user(room_id, username):
+    users = room_history[room_id]['users']
+    if username in users:
+        users.discard(username)
+        adjust_global_stats(online_users=-1)
+
+# 更新房间最后活跃时间
+def touch_room(room_id):
+    room_data = room_history[room_id]
+    room_data['last_active'] = datetime.now()
+    append_room_log(room_id, {'op': 'touch', 'at': room_data['last_active'].isoformat()})
+
+# 将文件关联到房间（调用者持有该房间的分段锁）
+def add_room_file(room_id, unique_filename):
+    room_data = room_history[room_id]
+    if 'files' not in room_data:
+        room_data['files'] = set()
+    if unique_filename not in room_data['files']:
+        room_data['files'].add(unique_filename)
+        room_data['stats']['file_bytes'] += get_file_size(unique_filename)
+    _add_file_ref(unique_filename, room_id)
+    append_room_log(room_id, {'op': 'file_add', 'name': unique_filename})
+
+# 取消房间与文件的关联（调用者持有该房间的分段锁）
+def remove_room_file(room_id, unique_filename):
+    room_data = room_history.get(room_id)
+    if room_data is not None and unique_filename in room_data.get('files', set()):
+        room_data['files'].discard(unique_filename)
+        room_data['stats']['file_bytes'] -= get_file_size(unique_filename)
+        append_room_log(room_id, {'op': 'file_remove', 'name': unique_filename})
+    _remove_file_ref(unique_filename, room_id)
+
+# 删除房间（调用者持有 room_registry_lock 与该房间的分段锁），返回房间关联的文件
+def remove_room(room_id):
+    room_data = room_history.pop(room_id)
+    room_files = set(room_data.get('files', set()))
+    for unique_filename in room_files:
+        _remove_file_ref(unique_filename, room_id)
+    # 从全局统计中扣除该房间的消息与在线用户
+    for message_type, count in room_data['stats']['by_type'].items():
+        adjust_global_stats(message_type=message_type, messages=-count)
+    adjust_global_stats(online_users=-len(room_data['users']))
+    compact_room_log(room_id)
+    return room_files
+
+# 根据已加载的房间重建消息索引、文件引用索引与聚合统计（启动时调用一次）
+def rebuild_room_indexes():
+    for room_id, room_data in room_history.items():
+        if rebuild_room_message_index(room_data):
+            # 写入带序号的快照
+            compact_room_log(room_id)
+    
+    with file_refs_lock:
+        file_room_refs.clear()
         for room_id, room_data in room_history.items():
-            # 如果房间当前没有用户,且距离最后活跃时间超过7天
-            if len(room_data['users']) == 0:
-                days_inactive = (now - room_data['last_active']).days
-                if days_inactive > 7:
-                    expired_rooms.append(room_id)
-        
-        # 清理过期房间及其关联文件
-        for room_id in expired_rooms:
-            # 获取房间关联的文件列表
-            room_files = room_history[room_id].get('files', set())
-            
-            # 删除房间记录
-            del room_history[room_id]
-            print(f"已清理过期房间: {room_id}")
-            
-            # 检查并删除不再被任何房间引用的文件
-            cleanup_orphaned_files(room_files)
+            for unique_filename in room_data.get('files', set()):
+                file_room_refs.setdefault(unique_filename, set()).add(room_id)
+        # 仅在启动时统计一次文件大小
+        for unique_filename in file_room_refs:
+            filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
+            if os.path.exists(filepath):
+                file_sizes[unique_filename] = os.path.getsize(filepath)
         
-        if expired_rooms:
-            save_history()
+        messages_by_type = {}
+        for room_data in room_history.values():
+            by_type = {}
+            for message in room_data['messages']:
+                message_type = message.type_name
+                by_type[message_type] = by_type.get(message_type, 0) + 1
+            room_data['stats'] = {
+                'by_type': by_type,
+                'file_bytes': sum(file_sizes.get(name, 0) for name in room_data.get('files', set()))
+            }
+            for message_type, count in by_type.items():
+                messages_by_type[message_type] = messages_by_type.get(message_type, 0) + count
         
-        return len(expired_rooms)
+        with aggregate_lock:
+            global_stats['messages_by_type'] = messages_by_type
+            global_stats['files'] = len(file_room_refs)
+            global_stats['file_bytes'] = sum(file_sizes.get(name, 0) for name in file_room_refs)
+            global_stats['online_users'] = sum(len(room_data['users']) for room_data in room_history.values())
+
+# 清理过期的房间历史
+def cleanup_expired_rooms():
+    now = datetime.now()
+    expired_rooms = []
+    expired_files = set()
+    
+    with room_registry_lock:
+        for room_id, room_data in list(room_history.items()):
+            with room_lock(room_id):
+                # 如果房间当前没有用户,且距离最后活跃时间超过7天
+                if len(room_data['users']) == 0:
+                    days_inactive = (now - room_data['last_active']).days
+                    if days_inactive > 7:
+                        expired_rooms.append(room_id)
+                        # 删除房间记录及其日志，并收集房间关联的文件
+                        expired_files.update(remove_room(room_id))
+                        print(f"已清理过期房间: {room_id}")
+    
+    # 检查并删除不再被任何房间引用的文件
+    if expired_files:
+        cleanup_orphaned_files(expired_files)
+    
+    return len(expired_rooms)
 
 # 清理孤立文件（不再被任何房间引用的文件）
 def cleanup_orphaned_files(candidate_files):
     """清理不再被任何房间引用的文件"""
-    # 收集所有仍在使用的文件
-    files_in_use = set()
-    for room_data in room_history.values():
-        files_in_use.update(room_data.get('files', set()))
-    
     # 删除不再被引用的文件
     with file_hash_lock:
         for unique_filename in candidate_files:
-            if unique_filename not in files_in_use:
+            if not is_file_referenced(unique_filename):
                 # 文件不再被任何房间使用，删除实体文件
                 filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
                 if os.path.exists(filepath):
                     try:
                         os.remove(filepath)
+                        forget_file_size(unique_filename)
                         print(f"已删除孤立文件: {unique_filename}")
                     except Exception as e:
                         print(f"删除文件失败 {unique_filename}: {e}")
                 
                 # 从哈希映射中移除
-                # 找到对应的哈希值并删除
-                hash_to_remove = None
-                for file_hash, filename in file_hash_map.items():
-                    if filename == unique_filename:
-                        hash_to_remove = file_hash
-                        break
-                
-                if hash_to_remove:
-                    del file_hash_map[hash_to_remove]
+                if remove_file_hash(unique_filename):
                     print(f"已从哈希映射中移除: {unique_filename}")
         
         # 保存更新后的哈希映射
         save_hash_map()
 
-# 初始化:加载历史记录并清理过期房间
+# 初始化:加载历史记录与哈希映射，重建文件索引后清理过期房间
 load_history()
-cleanup_expired_rooms()
 load_hash_map()  # 加载文件哈希映射
+rebuild_room_indexes()
+cleanup_expired_rooms()
 load_config()  # 加载网站配置
 load_admin_credentials()  # 加载管理员凭据
 load_ollama_config()  # 加载Ollama配置
@@ -412,35 +1370,37 @@ def get_rooms():
     if 'admin_logged_in' not in session:
         return jsonify({'success': False, 'error': '未登录'}), 401
     try:
-        with history_lock:
-            rooms_data = []
-            for room_id, room_data in room_history.items():
-                # 计算房间统计信息
-                total_messages = len(room_data['messages'])
-                file_count = len(room_data.get('files', set()))
-                
-                # 统计文件总大小
-                total_file_size = 0
-                for filename in room_data.get('files', set()):
-                    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                    if os.path.exists(filepath):
-                        total_file_size += os.path.getsize(filepath)
-                
-                rooms_data.append({
-                    'room_id': room_id,
-                    'message_count': total_messages,
-                    'file_count': file_count,
-                    'file_size': format_file_size(total_file_size),
-                    'last_active': room_data['last_active'].strftime('%Y-%m-%d %H:%M:%S'),
-                    'online_users': len(room_data['users']),
-                    'users': list(room_data['users'])
-                })
-            
-            return jsonify({
-                'success': True,
-                'rooms': rooms_data,
-                'total_rooms': len(rooms_data)
+        # 在锁内仅复制聚合计数，锁外构建响应（不访问文件系统）
+        snapshot = snapshot_rooms(lambda room_id, room_data: {
+            'room_id': room_id,
+            'message_count': len(room_data['messages']),
+            'capacity': room_data['messages'].maxlen,
+            'messages_by_type': dict(room_data['stats']['by_type']),
+            'file_count': len(room_data.get('files', set())),
+            'file_bytes': room_data['stats']['file_bytes'],
+            'last_active': room_data['last_active'],
+            'users': list(room_data['users'])
+        })
+        
+        rooms_data = []
+        for room in snapshot:
+            rooms_data.append({
+                'room_id': room['room_id'],
+                'message_count': room['message_count'],
+                'capacity': room['capacity'],
+                'messages_by_type': room['messages_by_type'],
+                'file_count': room['file_count'],
+                'file_size': format_file_size(room['file_bytes']),
+                'last_active': room['last_active'].strftime('%Y-%m-%d %H:%M:%S'),
+                'online_users': len(room['users']),
+                'users': room['users']
             })
+        
+        return jsonify({
+            'success': True,
+            'rooms': rooms_data,
+            'total_rooms': len(rooms_data)
+        })
     except Exception as e:
         print(f"获取房间列表失败: {e}")
         import traceback
@@ -453,21 +1413,22 @@ def get_room_detail(room_id):
     if 'admin_logged_in' not in session:
         return jsonify({'success': False, 'error': '未登录'}), 401
     try:
-        with history_lock:
+        with room_lock(room_id):
             if room_id not in room_history:
                 return jsonify({'success': False, 'error': '房间不存在'}), 404
             
             room_data = room_history[room_id]
-            return jsonify({
-                'success': True,
-                'room': {
-                    'room_id': room_id,
-                    'messages': room_data['messages'],
-                    'files': list(room_data.get('files', set())),
-                    'last_active': room_data['last_active'].strftime('%Y-%m-%d %H:%M:%S'),
-                    'online_users': list(room_data['users'])
-                }
-            })
+            room_detail = {
+                'room_id': room_id,
+                'messages': list(room_data['messages']),
+                'capacity': room_data['messages'].maxlen,
+                'files': list(room_data.get('files', set())),
+                'last_active': room_data['last_active'].strftime('%Y-%m-%d %H:%M:%S'),
+                'online_users': list(room_data['users'])
+            }
+        # 锁外转换为消息字典
+        room_detail['messages'] = [message.to_dict() for message in room_detail['messages']]
+        return jsonify({'success': True, 'room': room_detail})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -477,33 +1438,58 @@ def delete_room(room_id):
     if 'admin_logged_in' not in session:
         return jsonify({'success': False, 'error': '未登录'}), 401
     try:
-        with history_lock:
+        with room_registry_lock:
+            with room_lock(room_id):
+                if room_id not in room_history:
+                    return jsonify({'success': False, 'error': '房间不存在'}), 404
+                
+                # 删除房间及其日志，获取房间文件列表
+                room_files = remove_room(room_id)
+        
+        # 向房间内所有在线用户发送解散通知
+        socketio.emit('room_disbanded', {
+            'message': '当前房间被管理员解散',
+            'room': room_id
+        }, room=room_id)
+        
+        # 停止该房间的AI生成
+        cancel_room_ai(room_id)
+        
+        # 清理孤立文件
+        cleanup_orphaned_files(room_files)
+        
+        # 通知管理员数据已更新
+        notify_admin_update('rooms')
+        notify_admin_update('stats')
+        
+        print(f"管理员删除房间: {room_id}")
+        
+        return jsonify({'success': True, 'message': f'房间 {room_id} 已删除'})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+# 管理API - 设置房间消息容量
+@app.route('/api/admin/room/<room_id>/capacity', methods=['POST'])
+def update_room_capacity(room_id):
+    if 'admin_logged_in' not in session:
+        return jsonify({'success': False, 'error': '未登录'}), 401
+    try:
+        data = request.get_json() or {}
+        try:
+            capacity = int(data.get('capacity'))
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'error': '容量必须为整数'}), 400
+        if not MIN_ROOM_CAPACITY <= capacity <= MAX_ROOM_CAPACITY:
+            return jsonify({'success': False, 'error': f'容量范围为 {MIN_ROOM_CAPACITY}-{MAX_ROOM_CAPACITY}'}), 400
+        
+        with room_lock(room_id):
             if room_id not in room_history:
                 return jsonify({'success': False, 'error': '房间不存在'}), 404
-            
-            # 获取房间文件列表
-            room_files = room_history[room_id].get('files', set())
-            
-            # 向房间内所有在线用户发送解散通知
-            socketio.emit('room_disbanded', {
-                'message': '当前房间被管理员解散',
-                'room': room_id
-            }, room=room_id)
-            
-            # 删除房间
-            del room_history[room_id]
-            save_history()
-            
-            # 清理孤立文件
-            cleanup_orphaned_files(room_files)
-            
-            # 通知管理员数据已更新
-            notify_admin_update('rooms')
-            notify_admin_update('stats')
-            
-            print(f"管理员删除房间: {room_id}")
-            
-            return jsonify({'success': True, 'message': f'房间 {room_id} 已删除'})
+            set_room_capacity(room_id, capacity)
+        
+        notify_admin_update('rooms')
+        notify_admin_update('stats')
+        return jsonify({'success': True, 'message': f'房间 {room_id} 容量已设为 {capacity}', 'capacity': capacity})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -566,6 +1552,7 @@ def set_ai_provider():
         with ai_provider_lock:
             global ai_provider
             ai_provider = provider
+        schedule_ai_warmup()
         if save_ai_provider():
             return jsonify({'success': True, 'message': 'AI提供方已更新', 'provider': ai_provider})
         else:
@@ -579,100 +1566,108 @@ def get_stats():
     if 'admin_logged_in' not in session:
         return jsonify({'success': False, 'error': '未登录'}), 401
     try:
-        with history_lock:
-            # 统计总消息数
-            total_messages = sum(len(room['messages']) for room in room_history.values())
-            
-            # 统计总文件数和大小
-            all_files = set()
-            for room_data in room_history.values():
-                all_files.update(room_data.get('files', set()))
-            
-            total_file_size = 0
-            for filename in all_files:
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                if os.path.exists(filepath):
-                    total_file_size += os.path.getsize(filepath)
-            
-            # 统计在线用户数
-            online_users = sum(len(room['users']) for room in room_history.values())
-            
-            # 计算服务器运行时长
-            uptime = datetime.now() - server_start_time
-            days = uptime.days
-            hours, remainder = divmod(uptime.seconds, 3600)
-            minutes, seconds = divmod(remainder, 60)
-            
-            uptime_str = ''
-            if days > 0:
-                uptime_str += f'{days}天 '
-            uptime_str += f'{hours}小时 {minutes}分钟 {seconds}秒'
-            
-            # 获取服务器配置信息（优雅降级，避免 psutil 缺失导致 500）
-            import sys
-            import platform
-            import shutil
-            try:
-                import psutil  # 可选依赖
-            except Exception:
-                psutil = None
+        # 读取增量维护的全局统计（O(1)，不访问文件系统）
+        aggregates = get_global_stats()
+        with room_registry_lock:
+            total_rooms = len(room_history)
+        
+        # 计算服务器运行时长
+        uptime = datetime.now() - server_start_time
+        days = uptime.days
+        hours, remainder = divmod(uptime.seconds, 3600)
+        minutes, seconds = divmod(remainder, 60)
+        
+        uptime_str = ''
+        if days > 0:
+            uptime_str += f'{days}天 '
+        uptime_str += f'{hours}小时 {minutes}分钟 {seconds}秒'
+        
+        # 获取服务器配置信息（优雅降级，避免 psutil 缺失导致 500）
+        import platform
+        import shutil
+        try:
+            import psutil  # 可选依赖
+        except Exception:
+            psutil = None
 
-            # 获取内存信息
-            if psutil:
-                memory = psutil.virtual_memory()
-                total_memory_gb = memory.total / (1024 ** 3)
-            else:
-                total_memory_gb = None
-            
-            # 获取磁盘信息（使用标准库，避免依赖 psutil）
-            try:
-                disk = shutil.disk_usage(os.getcwd())
-                total_disk_gb = disk.total / (1024 ** 3)
-            except Exception:
-                total_disk_gb = None
-            
-            # 获取处理器信息
-            if psutil:
-                cpu_count = psutil.cpu_count(logical=False) or 0
-                cpu_count_logical = psutil.cpu_count(logical=True) or (os.cpu_count() or 0)
-            else:
-                cpu_count = None
-                cpu_count_logical = os.cpu_count() or 0
-            cpu_info = f'{platform.processor()} ({cpu_count}核{cpu_count_logical}线程)' if cpu_count else platform.processor()
-            
-            # AI请求统计
-            with ai_stats_lock:
-                total_ai = ai_request_total
-                success_ai = ai_request_success
-            success_rate = 0.0
-            if total_ai > 0:
-                success_rate = (success_ai / total_ai) * 100.0
-            
-            return jsonify({
-                'success': True,
-                'stats': {
-                    'total_rooms': len(room_history),
-                    'total_messages': total_messages,
-                    'total_files': len(all_files),
-                    'total_file_size': format_file_size(total_file_size),
-                    'online_users': online_users,
-                    'server_status': 'running',
-                    'uptime': uptime_str,
-                    'start_time': server_start_time.strftime('%Y-%m-%d %H:%M:%S'),
-                    'ai_requests_total': total_ai,
-                    'ai_success_rate': f"{success_rate:.1f}%",
-                    # 服务器配置信息
-                    'server_config': {
-                        'python_version': platform.python_version(),
-                        'os': f'{platform.system()} {platform.release()}',
-                        'processor': cpu_info,
-                        'total_memory': f'{total_memory_gb:.1f} GB' if total_memory_gb is not None else '-',
-                        'total_disk': f'{total_disk_gb:.1f} GB' if total_disk_gb is not None else '-',
-                        'max_file_size': '5GB',
-                        'upload_folder': app.config['UPLOAD_FOLDER']
-                    }
+        # 获取内存信息
+        if psutil:
+            memory = psutil.virtual_memory()
+            total_memory_gb = memory.total / (1024 ** 3)
+        else:
+            total_memory_gb = None
+        
+        # 获取磁盘信息（使用标准库，避免依赖 psutil）
+        try:
+            disk = shutil.disk_usage(os.getcwd())
+            total_disk_gb = disk.total / (1024 ** 3)
+        except Exception:
+            total_disk_gb = None
+        
+        # 获取处理器信息
+        if psutil:
+            cpu_count = psutil.cpu_count(logical=False) or 0
+            cpu_count_logical = psutil.cpu_count(logical=True) or (os.cpu_count() or 0)
+        else:
+            cpu_count = None
+            cpu_count_logical = os.cpu_count() or 0
+        cpu_info = f'{platform.processor()} ({cpu_count}核{cpu_count_logical}线程)' if cpu_count else platform.processor()
+        
+        # AI请求统计
+        with ai_stats_lock:
+            total_ai = ai_request_total
+            success_ai = ai_request_success
+        success_rate = 0.0
+        if total_ai > 0:
+            success_rate = (success_ai / total_ai) * 100.0
+        
+        return jsonify({
+            'success': True,
+            'stats': {
+                'total_rooms': total_rooms,
+                'total_messages': aggregates['total_messages'],
+                'messages_by_type': aggregates['messages_by_type'],
+                'total_files': aggregates['files'],
+                'total_file_size': format_file_size(aggregates['file_bytes']),
+                'online_users': aggregates['online_users'],
+                'server_status': 'running',
+                'uptime': uptime_str,
+                'start_time': server_start_time.strftime('%Y-%m-%d %H:%M:%S'),
+                'ai_requests_total': total_ai,
+                'ai_success_rate': f"{success_rate:.1f}%",
+                # 后台持久化状态
+                'persistence': get_persist_status(),
+                # 链接预览缓存命中情况
+                'link_preview_cache': get_link_preview_cache_stats(),
+                'link_preview_pool': get_link_preview_pool_stats(),
+                # AI请求调度（并发、排队与等待时间）
+                'ai_scheduler': get_ai_scheduler_stats(),
+                # AI回答缓存与相同请求合并
+                'ai_response_cache': get_ai_response_cache_stats(),
+                # 提示 token 估算（上下文预算）
+                'ai_prompt': get_ai_prompt_stats(),
+                # 房间滚动摘要
+                'ai_summary': get_summary_status(),
+                # 相关历史检索
+                'ai_retrieval': get_ai_retrieval_stats(),
+                # AI回答推送（数据包数与字节数）
+                'ai_stream': get_ai_stream_stats(),
+                # AI节点池（健康状态、负载、延迟与错误）
+                'ai_endpoints': get_ai_endpoint_stats(),
+                # 模型预热/保活与冷/热首字耗时
+                'ai_warmup': get_ai_warmup_stats(),
+                # 服务器配置信息
+                'server_config': {
+                    'python_version': platform.python_version(),
+                    'os': f'{platform.system()} {platform.release()}',
+                    'processor': cpu_info,
+                    'total_memory': f'{total_memory_gb:.1f} GB' if total_memory_gb is not None else '-',
+                    'total_disk': f'{total_disk_gb:.1f} GB' if total_disk_gb is not None else '-',
+                    'max_file_size': '5GB',
+                    'upload_folder': app.config['UPLOAD_FOLDER']
                 }
-            })
+            }
+        })
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -725,22 +1720,46 @@ def update_ollama_config():
     if 'admin_logged_in' not in session:
         return jsonify({'success': False, 'error': '未登录'}), 401
     try:
-        data = request.get_json()
-        with ollama_config_lock:
+        data = request.get_json() or {}
+        # 先校验并解析全部字段，任何一项无效都不改动当前配置
+        updates = {}
+        try:
             if 'enabled' in data:
-                ollama_config['enabled'] = bool(data['enabled'])
+                updates['enabled'] = parse_config_bool(data['enabled'])
             if 'api_url' in data:
-                ollama_config['api_url'] = data['api_url']
+                updates['api_url'] = data['api_url']
             if 'model' in data:
-                ollama_config['model'] = data['model']
+                updates['model'] = data['model']
             if 'temperature' in data:
-                ollama_config['temperature'] = float(data['temperature'])
+                updates['temperature'] = float(data['temperature'])
             if 'max_tokens' in data:
-                ollama_config['max_tokens'] = int(data['max_tokens'])
+                updates['max_tokens'] = int(data['max_tokens'])
             if 'system_prompt' in data:
-                ollama_config['system_prompt'] = data['system_prompt']
+                updates['system_prompt'] = data['system_prompt']
             if 'ai_name' in data:
-                ollama_config['ai_name'] = data['ai_name'].strip() or 'AI助手'
+                updates['ai_name'] = data['ai_name'].strip() or 'AI助手'
+            for key, default in AI_TUNABLE_DEFAULTS.items():
+                if key in data:
+                    updates[key] = coerce_config_value(data[key], default)
+            if 'model_context_tokens' in data:
+                updates['model_context_tokens'] = parse_model_context_tokens(data['model_context_tokens'])
+            if 'endpoints' in data:
+                updates['endpoints'] = parse_ai_endpoints(data['endpoints'])
+            if 'stream_flush_tiers' in data:
+                updates['stream_flush_tiers'] = parse_stream_flush_tiers(data['stream_flush_tiers'])
+            for key, default in OLLAMA_KEEP_ALIVE_DEFAULTS.items():
+                if key in data:
+                    updates[key] = coerce_config_value(data[key], default)
+        except (TypeError, ValueError, AttributeError) as e:
+            return jsonify({'success': False, 'error': f'配置无效: {e}'}), 400
+        with ollama_config_lock:
+            ollama_config.update(updates)
+        
+        # 连接池按新配置重建
+        reset_http_session('ollama')
+        # 模型或地址变化后重新预热
+        if any(key in data for key in ('enabled', 'api_url', 'model', 'endpoints', 'keep_alive', 'warmup')):
+            schedule_ai_warmup()
         
         # 在锁外保存配置
         if save_ollama_config():
@@ -768,10 +1787,12 @@ def test_ollama():
                 api_url = ollama_config['api_url']
         
         # 尝试连接Ollama API，设置较短的超时时间
-        test_response = requests.get(f"{api_url}/api/tags", timeout=3)
+        adapter = create_ai_adapter('ollama')
+        http_session, http_settings = adapter.session()
+        url, request_kwargs = adapter.models_request({'url': api_url.rstrip('/')})
+        test_response = http_session.get(url, timeout=(http_settings['connect_timeout'], 3), **request_kwargs)
         if test_response.status_code == 200:
-            models = test_response.json().get('models', [])
-            model_names = [m['name'] for m in models]
+            model_names = adapter.parse_models(test_response.json())
             return jsonify({
                 'success': True, 
                 'message': 'Ollama连接成功',
@@ -804,23 +1825,40 @@ def update_thirdparty_config():
         return jsonify({'success': False, 'error': '未登录'}), 401
     try:
         data = request.get_json() or {}
-        with third_party_lock:
+        # 先校验并解析全部字段，任何一项无效都不改动当前配置
+        updates = {}
+        try:
             if 'enabled' in data:
-                third_party_ai_config['enabled'] = bool(data['enabled'])
+                updates['enabled'] = parse_config_bool(data['enabled'])
             if 'api_base_url' in data:
-                third_party_ai_config['api_base_url'] = data['api_base_url'].rstrip('/')
+                updates['api_base_url'] = data['api_base_url'].rstrip('/')
             if 'api_key' in data:
-                third_party_ai_config['api_key'] = data['api_key']
+                updates['api_key'] = data['api_key']
             if 'model' in data:
-                third_party_ai_config['model'] = data['model']
+                updates['model'] = data['model']
             if 'temperature' in data:
-                third_party_ai_config['temperature'] = float(data['temperature'])
+                updates['temperature'] = float(data['temperature'])
             if 'max_tokens' in data:
-                third_party_ai_config['max_tokens'] = int(data['max_tokens'])
+                updates['max_tokens'] = int(data['max_tokens'])
             if 'system_prompt' in data:
-                third_party_ai_config['system_prompt'] = data['system_prompt']
+                updates['system_prompt'] = data['system_prompt']
             if 'ai_name' in data:
-                third_party_ai_config['ai_name'] = data['ai_name'].strip() or 'AI助手'
+                updates['ai_name'] = data['ai_name'].strip() or 'AI助手'
+            for key, default in AI_TUNABLE_DEFAULTS.items():
+                if key in data:
+                    updates[key] = coerce_config_value(data[key], default)
+            if 'model_context_tokens' in data:
+                updates['model_context_tokens'] = parse_model_context_tokens(data['model_context_tokens'])
+            if 'endpoints' in data:
+                updates['endpoints'] = parse_ai_endpoints(data['endpoints'])
+            if 'stream_flush_tiers' in data:
+                updates['stream_flush_tiers'] = parse_stream_flush_tiers(data['stream_flush_tiers'])
+        except (TypeError, ValueError, AttributeError) as e:
+            return jsonify({'success': False, 'error': f'配置无效: {e}'}), 400
+        with third_party_lock:
+            third_party_ai_config.update(updates)
+        # 连接池按新配置重建
+        reset_http_session('thirdparty')
         if save_third_party_config():
             return jsonify({'success': True, 'message': '第三方AI配置已更新', 'config': third_party_ai_config})
         else:
@@ -840,14 +1878,13 @@ def test_thirdparty():
         if not base_url or not api_key:
             return jsonify({'success': False, 'error': '请提供API地址与API Key'}), 400
         # 尝试列出模型
-        headers = {
-            'Authorization': f'Bearer {api_key}'
-        }
         try:
-            resp = requests.get(f"{base_url}/v1/models", headers=headers, timeout=5)
+            adapter = create_ai_adapter('thirdparty')
+            http_session, http_settings = adapter.session()
+            url, request_kwargs = adapter.models_request({'url': base_url.rstrip('/'), 'api_key': api_key})
+            resp = http_session.get(url, timeout=(http_settings['connect_timeout'], 5), **request_kwargs)
             if resp.status_code == 200:
-                data = resp.json()
-                models = [m.get('id') for m in data.get('data', [])]
+                models = adapter.parse_models(resp.json())
                 return jsonify({'success': True, 'message': '第三方API连接成功', 'models': models})
             else:
                 return jsonify({'success': False, 'error': f'HTTP {resp.status_code}: {resp.text[:200]}'})
@@ -885,52 +1922,63 @@ def get_file_type(filename):
 # Socket.IO事件 - 获取房间历史消息
 @socketio.on('get_room_history')
 def handle_get_room_history(data):
-    """用户主动请求房间历史消息"""
+    """用户主动请求房间历史消息（按游标分页）
+
+    before/after 为消息序号游标，limit 为每页条数。
+    """
     room = data.get('room')
     filter_type = data.get('filter', 'all')  # all, video, image, file
+    before = data.get('before')
+    after = data.get('after')
     
     if not room:
         emit('room_history_response', {'success': False, 'error': '房间号不能为空'})
         return
+    if filter_type not in ('all', 'video', 'image', 'file'):
+        emit('room_history_response', {'success': False, 'error': '不支持的筛选类型'})
+        return
     
     try:
-        with history_lock:
-            if room not in room_history:
-                emit('room_history_response', {
-                    'success': True,
-                    'messages': [],
-                    'filter': filter_type
-                })
-                return
-            
-            all_messages = room_history[room]['messages']
-            
-            # 根据过滤类型筛选消息
-            filtered_messages = []
-            if filter_type == 'all':
-                filtered_messages = all_messages
-            elif filter_type == 'video':
-                # 包含视频文件的消息
-                for msg in all_messages:
-                    if msg.get('file_info') and msg['file_info'].get('file_type') == 'video':
-                        filtered_messages.append(msg)
-            elif filter_type == 'image':
-                # 包含图片文件的消息
-                for msg in all_messages:
-                    if msg.get('file_info') and msg['file_info'].get('file_type') == 'image':
-                        filtered_messages.append(msg)
-            elif filter_type == 'file':
-                # 包含任何文件的消息
-                for msg in all_messages:
-                    if msg.get('file_info'):
-                        filtered_messages.append(msg)
-            
-            emit('room_history_response', {
-                'success': True,
-                'messages': filtered_messages,
+        try:
+            limit = int(data.get('limit') or HISTORY_PAGE_SIZE)
+            before = int(before) if before is not None else None
+            after = int(after) if after is not None else None
+        except (TypeError, ValueError):
+            emit('room_history_response', {'success': False, 'error': '分页参数无效'})
+            return
+        limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+        
+        # 仅在锁内定位并复制当前页，发送在锁外进行
+        with room_lock(room):
+            room_data = room_history.get(room)
+            if room_data is not None:
+                page, has_more_before, has_more_after = get_room_history_page(
+                    room_data, filter_type, before=before, after=after, limit=limit
+                )
+                total = len(room_data['messages'])
+        
+        if room_data is None:
+            emit('room_history_response', {
+                'success': True,
+                'messages': [],
                 'filter': filter_type,
-                'total': len(all_messages)
+                'before': before,
+                'after': after,
+                'has_more_before': False,
+                'has_more_after': False
             })
+            return
+        
+        emit('room_history_response', {
+            'success': True,
+            'messages': [message.to_dict() for message in page],
+            'filter': filter_type,
+            'total': total,
+            'before': before,
+            'after': after,
+            'has_more_before': has_more_before,
+            'has_more_after': has_more_after
+        })
     except Exception as e:
         print(f"获取房间历史失败: {e}")
         import traceback
@@ -956,19 +2004,10 @@ def get_files():
                     file_mtime = datetime.fromtimestamp(file_stat.st_mtime).strftime('%Y-%m-%d %H:%M:%S')
                     
                     # 检查文件被哪些房间引用
-                    referenced_rooms = []
-                    with history_lock:
-                        for room_id, room_data in room_history.items():
-                            if filename in room_data.get('files', set()):
-                                referenced_rooms.append(room_id)
+                    referenced_rooms = list(get_file_refs(filename))
                     
                     # 检查是否在哈希映射中
-                    is_hashed = False
-                    with file_hash_lock:
-                        for hash_value, hash_filename in file_hash_map.items():
-                            if hash_filename == filename:
-                                is_hashed = True
-                                break
+                    is_hashed = filename in file_hash_by_name
                     
                     # 获取文件类型
                     file_type = get_file_type(filename)
@@ -1011,26 +2050,18 @@ def delete_file(filename):
             return jsonify({'success': False, 'error': '文件不存在'}), 404
         
         # 从所有房间中移除该文件的引用
-        with history_lock:
-            for room_id, room_data in room_history.items():
-                if filename in room_data.get('files', set()):
-                    room_data['files'].discard(filename)
-            save_history()
+        for room_id in get_file_refs(filename):
+            with room_lock(room_id):
+                remove_room_file(room_id, filename)
         
         # 从哈希映射中移除
         with file_hash_lock:
-            hash_to_remove = None
-            for file_hash, hash_filename in file_hash_map.items():
-                if hash_filename == filename:
-                    hash_to_remove = file_hash
-                    break
-            
-            if hash_to_remove:
-                del file_hash_map[hash_to_remove]
+            if remove_file_hash(filename):
                 save_hash_map()
         
         # 删除物理文件
         os.remove(filepath)
+        forget_file_size(filename)
         print(f"已删除文件: {filename}")
         
         # 通知管理员文件已更新
@@ -1058,13 +2089,8 @@ def cleanup_orphaned_files_api():
             all_files = set(os.listdir(upload_folder))
         
         # 获取所有被引用的文件
-        referenced_files = set()
-        with history_lock:
-            for room_data in room_history.values():
-                referenced_files.update(room_data.get('files', set()))
-        
         # 找出孤立文件
-        orphaned_files = all_files - referenced_files
+        orphaned_files = {filename for filename in all_files if not is_file_referenced(filename)}
         
         deleted_count = 0
         for filename in orphaned_files:
@@ -1072,18 +2098,13 @@ def cleanup_orphaned_files_api():
             if os.path.exists(filepath):
                 try:
                     os.remove(filepath)
+                    forget_file_size(filename)
                     deleted_count += 1
                     print(f"清理孤立文件: {filename}")
                     
                     # 从哈希映射中移除
                     with file_hash_lock:
-                        hash_to_remove = None
-                        for file_hash, hash_filename in file_hash_map.items():
-                            if hash_filename == filename:
-                                hash_to_remove = file_hash
-                                break
-                        if hash_to_remove:
-                            del file_hash_map[hash_to_remove]
+                        remove_file_hash(filename)
                 except Exception as e:
                     print(f"删除孤立文件失败 {filename}: {e}")
         
@@ -1122,37 +2143,28 @@ def on_join(data):
     room_members[room][username] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     
     # 初始化房间历史记录
-    with history_lock:
+    with room_registry_lock:
         if room not in room_history:
-            room_history[room] = {
-                'messages': [],
-                'last_active': datetime.now(),
-                'users': set(),
-                'files': set()  # 初始化文件集合
-            }
-        
-        room_history[room]['users'].add(username)
-        room_history[room]['last_active'] = datetime.now()
+            room_history[room] = _new_room_data()
+    
+    with room_lock(room):
+        if room in room_history:
+            add_room_user(room, username)
+            touch_room(room)
         
         # 不再自动发送历史消息，改为用户点击历史记录按钮时获取
     
-    # 发送系统消息
-    join_message = {
-        'username': '系统',
-        'message': f'{username} 加入了房间',
-        'type': 'system',
-        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    }
-    
-    emit('message', join_message, room=room)
-    
-    # 保存系统消息到历史
+    # 系统消息先保存到历史以分配序号（分页游标），再发送
+    join_message = ChatMessage(MessageType.SYSTEM, '系统', f'{username} 加入了房间')
     try:
-        with history_lock:
-            room_history[room]['messages'].append(join_message)
+        with room_lock(room):
+            if room in room_history:
+                append_room_message(room, join_message)
     except Exception as e:
         print(f"保存加入消息失败: {e}")
     
+    emit('message', join_message.to_dict(), room=room)
+    
     # 构建成员列表（包含加入时间）
     members_with_time = [{
         'username': member,
@@ -1166,6 +2178,9 @@ def on_join(data):
         'members_detail': members_with_time
     }, room=room)
     
+    # 中途加入（或重连）时补齐正在生成的AI回答
+    send_ai_catch_up(room, request.sid)
+    
     # 通知管理员房间数据已更新
     notify_admin_update('rooms')
     notify_admin_update('stats')
@@ -1189,35 +2204,32 @@ def on_leave(data):
             del room_members[room]
     
     # 更新房间历史记录
+    room_empty = False
     try:
-        with history_lock:
+        with room_lock(room):
             if room in room_history:
-                room_history[room]['users'].discard(username)
+                remove_room_user(room, username)
                 # 如果房间没有用户了,更新最后活跃时间并保存
-                if len(room_history[room]['users']) == 0:
-                    room_history[room]['last_active'] = datetime.now()
-                    save_history()
+                room_empty = len(room_history[room]['users']) == 0
+                if room_empty:
+                    touch_room(room)
+        # 房间已无人：停止该房间的AI生成
+        if room_empty:
+            cancel_room_ai(room)
     except Exception as e:
         print(f"更新房间历史失败: {e}")
     
-    # 发送系统消息
-    leave_message = {
-        'username': '系统',
-        'message': f'{username} 离开了房间',
-        'type': 'system',
-        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    }
-    
-    emit('message', leave_message, room=room)
-    
-    # 保存离开消息到历史
+    # 离开消息先保存到历史以分配序号，再发送
+    leave_message = ChatMessage(MessageType.SYSTEM, '系统', f'{username} 离开了房间')
     try:
-        with history_lock:
+        with room_lock(room):
             if room in room_history:
-                room_history[room]['messages'].append(leave_message)
+                append_room_message(room, leave_message)
     except Exception as e:
         print(f"保存离开消息失败: {e}")
     
+    emit('message', leave_message.to_dict(), room=room)
+    
     # 更新房间人数
     if room in rooms:
         # 构建成员列表（包含加入时间）
@@ -1268,528 +2280,2156 @@ def handle_message(data):
         message = raw_message
     ai_enabled = data.get('ai_enabled', False)
     custom_ai_name = data.get('custom_ai_name', None)  # 获取自定义AI昵称
-    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    if ai_enabled:
+        # 开启 AI 的房间在活跃期间保持模型驻留
+        note_ai_room_activity(room)
     
     # 检测消息中是否包含链接
     urls = re.findall(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+', message)
     
     # 构建消息对象(不带预览)
-    message_obj = {
-        'username': username,
-        'message': message,
-        'type': 'user',
-        'link_preview': None,
-        'timestamp': timestamp,
-        'message_id': f"{room}_{username}_{int(time.time() * 1000)}"  # 唯一消息ID
-    }
+    message_obj = ChatMessage(
+        MessageType.USER, username, message,
+        message_id=f"{room}_{username}_{int(time.time() * 1000)}"  # 唯一消息ID
+    )
     
-    # 立即发送消息
-    emit('message', message_obj, room=room)
-    
-    # 保存消息到历史记录
+    # 先保存到历史记录以分配序号，客户端收到的消息即带有分页游标
     try:
-        with history_lock:
+        with room_lock(room):
             if room in room_history:
-                room_history[room]['messages'].append(message_obj)
-                room_history[room]['last_active'] = datetime.now()
-                # 限制历史消息数量,最多保存1000条
-                if len(room_history[room]['messages']) > 1000:
-                    room_history[room]['messages'] = room_history[room]['messages'][-1000:]
-                # 每10条消息保存一次,减少IO操作
-                if len(room_history[room]['messages']) % 10 == 0:
-                    save_history()
+                append_room_message(room, message_obj)
     except Exception as e:
         print(f"保存消息历史失败: {e}")
     
+    # 立即发送消息
+    emit('message', message_obj.to_dict(), room=room)
+    
     # 如果有链接,异步获取预览
     if urls:
-        # 使用 socketio 的后台任务机制
-        socketio.start_background_task(fetch_and_send_preview, urls[0], message_obj['message_id'], room)
+        # 交给链接预览工作线程池（消息中的每个链接各一个任务，去重并限制数量）
+        for index, url in enumerate(list(dict.fromkeys(urls))[:LINK_PREVIEW_MAX_URLS]):
+            submit_link_preview(url, message_obj.message_id, room, index)
     
-    # 如果启用了AI，调用Ollama
+    # 如果启用了AI，交给AI调度器（过载时立即告知请求者）
     if ai_enabled and ollama_config['enabled']:
-        socketio.start_background_task(handle_ai_response, room, username, message, custom_ai_name)
+        accepted, result = submit_ai_request(room, username, message, custom_ai_name)
+        if not accepted:
+            emit('ai_request_rejected', {'error': result})
+
+# 取消AI生成（房间内任何成员都可以停止正在生成或排队的回答）
+@socketio.on('cancel_ai')
+def handle_cancel_ai(data):
+    room = data.get('room')
+    message_id = data.get('message_id')
+    if not room or not message_id:
+        return
+    # 只允许取消本房间的请求
+    if message_id not in _find_ai_requests(room):
+        return
+    cancel_ai_generation(message_id)
 
-def fetch_and_send_preview(url, message_id, room):
-    """后台线程获取链接预览并发送更新"""
+def fetch_and_send_preview(url, message_id, room, index=0):
+    """后台线程获取链接预览并发送更新；index 为链接在消息中的位置"""
     try:
-        link_preview = get_link_preview(url)
+        link_preview = get_cached_link_preview(url)
         if link_preview:
             # 发送链接预览更新
             socketio.emit('link_preview_update', {
                 'message_id': message_id,
-                'link_preview': link_preview
+                'link_preview': link_preview,
+                'index': index
             }, room=room)
             
             # 更新历史记录中的预览信息
             try:
-                with history_lock:
+                with room_lock(room):
                     if room in room_history:
-                        for msg in reversed(room_history[room]['messages']):
-                            if msg.get('message_id') == message_id:
-                                msg['link_preview'] = link_preview
-                                break
+                        msg = find_room_message(room_history[room], message_id)
+                        if msg is not None:
+                            msg.set_link_preview(index, link_preview)
+                            append_room_log(room, {
+                                'op': 'preview',
+                                'id': message_id,
+                                'index': index,
+                                'link_preview': link_preview
+                            })
             except Exception as e:
                 print(f"更新历史记录预览失败: {e}")
     except Exception as e:
         print(f"获取链接预览失败: {e}")
 
-def build_ai_context_messages(room, max_items=20):
-    """构建最近聊天上下文（不包含文件），含昵称与时间。
+# 上下文中滚动摘要的前缀；摘要提示中AI发言使用的名称
+AI_SUMMARY_CONTEXT_PREFIX = '【更早对话摘要】'
+AI_SUMMARY_ASSISTANT_LABEL = 'AI'
+# 上下文中检索到的相关历史消息的前缀
+AI_RETRIEVAL_CONTEXT_PREFIX = '【相关历史消息】'
+# 相关历史检索：每次注入上下文的条数（0 为关闭），可在提供方配置中调整
+AI_RETRIEVAL_DEFAULTS = {
+    'context_retrieval_k': 3
+}
+ai_retrieval_stats = {'queries': 0, 'results': 0, 'total_ms': 0.0}  # 由 ai_stats_lock 保护
+
+# 检索房间历史中与问题最相关的消息（不含最近窗口中已有的消息）
+def retrieve_room_messages(room, query, k):
+    started = time.time()
+    with room_lock(room):
+        room_data = room_history.get(room)
+        if room_data is None:
+            return []
+        ai_context = room_data['ai_context']
+        before_seq = ai_context[0].seq if ai_context else None
+        results = room_data['search_index'].search(query, k, before_seq)
+    with ai_stats_lock:
+        ai_retrieval_stats['queries'] += 1
+        ai_retrieval_stats['results'] += len(results)
+        ai_retrieval_stats['total_ms'] += (time.time() - started) * 1000
+    return results
+
+def get_ai_retrieval_stats():
+    with ai_stats_lock:
+        stats = dict(ai_retrieval_stats)
+    total_ms = stats.pop('total_ms')
+    stats['avg_ms'] = round(total_ms / stats['queries'], 2) if stats['queries'] else 0.0
+    return stats
+
+def build_ai_context_messages(room, max_items=AI_CONTEXT_MAX_ITEMS):
+    """构建最近聊天上下文（不包含文件与系统消息），用户消息带昵称前缀。
 
     返回OpenAI/Ollama兼容的messages结构：[{role, content}...]
-    content格式：『YYYY-MM-DD HH:MM:SS』『昵称』消息内容
+    上下文取自房间增量维护的 ai_context 窗口，只在锁内复制最近 max_items 条；
+    房间有滚动摘要时，摘要作为第一条 system 消息放在最近窗口之前。
     """
     context_messages = []
     try:
-        with history_lock:
-            if room in room_history:
-                all_messages = room_history[room]['messages']
-                # 过滤掉文件与系统类消息，仅保留用户与AI消息
-                filtered = []
-                for msg in reversed(all_messages):
-                    t = msg.get('type')
-                    if t == 'file':
-                        continue
-                    if t in ('user', 'ai'):
-                        filtered.append(msg)
-                # 取最近max_items条，并恢复为时间正序
-                recent = list(reversed(filtered[:max_items]))
-                for m in recent:
-                    role = 'assistant' if m.get('type') == 'ai' else 'user'
-                    name = m.get('username') or ''
-                    text = m.get('message') or ''
-                    # 仅保留用户昵称；AI上下文不包含昵称前缀
-                    content = text if role == 'assistant' else f"【{name}】{text}"
-                    context_messages.append({'role': role, 'content': content})
+        with room_lock(room):
+            room_data = room_history.get(room)
+            if room_data is None:
+                return context_messages
+            ai_context = room_data['ai_context']
+            recent = list(islice(ai_context, max(0, len(ai_context) - max_items), None))
+            summary = room_data['summary']
+        if summary:
+            context_messages.append({'role': 'system', 'content': AI_SUMMARY_CONTEXT_PREFIX + summary['text']})
+        for m in recent:
+            role = 'assistant' if m.type == MessageType.AI else 'user'
+            # 仅保留用户昵称；AI上下文不包含昵称前缀
+            content = m.text if role == 'assistant' else f"【{m.username}】{m.text}"
+            context_messages.append({'role': role, 'content': content})
     except Exception as e:
         print(f"构建AI上下文失败: {e}")
     return context_messages
 
-# AI响应处理
-def handle_ai_response(room, username, user_message, custom_ai_name=None):
-    """处理AI响应并流式发送到房间，支持 Ollama 与第三方(OpenAI兼容)"""
-    global ai_request_total, ai_request_success
-    message_id = f"{room}_AI_{int(time.time() * 1000)}"
-    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+# 流式解析“深度思考”标签
+class ThinkTagParser:
+    """增量解析模型输出中的 <think>...</think>
 
-    try:
-        # 统计一次AI请求开始
-        with ai_stats_lock:
-            ai_request_total += 1
-        notify_admin_update('stats')
-        # 读取当前默认提供方
-        with ai_provider_lock:
-            provider = ai_provider
+    每个片段只扫描一次，标签可以被拆分在相邻片段之间；
+    feed 返回 (回答文本, 推理文本)，多段推理之间以空行分隔。
+    """
+    OPEN_TAG = '<think>'
+    CLOSE_TAG = '</think>'
 
-        # 准备通用的系统提示与昵称
-        if provider == 'thirdparty':
-            with third_party_lock:
-                base_url = third_party_ai_config['api_base_url']
-                api_key = third_party_ai_config['api_key']
-                model = third_party_ai_config['model']
-                temperature = third_party_ai_config['temperature']
-                max_tokens = third_party_ai_config['max_tokens']
-                system_prompt = third_party_ai_config['system_prompt']
-                default_ai_name = third_party_ai_config.get('ai_name', 'AI助手')
-            ai_name = custom_ai_name if custom_ai_name else default_ai_name
-
-            # 标记是否可能支持“深度思考”（例如 deepseek reasoner 等）
-            supports_reasoning = any(s in (model or '').lower() for s in ['reason', 'deepseek', 'r1'])
-            full_reasoning = ''
-
-            # 开始事件
-            socketio.emit('ai_response_start', {
-                'message_id': message_id,
-                'timestamp': timestamp,
-                'ai_name': ai_name,
-                'supports_reasoning': supports_reasoning
-            }, room=room)
-            socketio.sleep(0.1)
-
-            # 构建OpenAI兼容请求（加入最近上下文，并优化提示词）
-            augmented_system_prompt = (
-                (system_prompt or '') +
-                "\n\n注意：你将收到一段最近的对话上下文（最多20条）。其中：\n" +
-                "- 用户消息采用格式：【昵称】消息文本\n" +
-                "- AI消息为纯文本，不包含昵称前缀\n" +
-                "请在理解上下文时正确区分不同用户的昵称，保持回答简洁友好。"
-            )
-            payload = {
-                'model': model,
-                'messages': (
-                    [{'role': 'system', 'content': augmented_system_prompt}] +
-                    build_ai_context_messages(room, max_items=20) +
-                    [{'role': 'user', 'content': user_message}]
-                ),
+    def __init__(self):
+        self.in_think = False
+        self._pending = ''  # 片段末尾可能属于标签的前缀，留到下一片段判断
+        self._blocks = 0
+        self._answer_started = False
+
+    @staticmethod
+    def _partial_tag_length(text, tag, start):
+        """text 末尾与 tag 前缀重合的最大长度"""
+        for length in range(min(len(tag) - 1, len(text) - start), 0, -1):
+            if text.endswith(tag[:length]):
+                return length
+        return 0
+
+    def feed(self, text):
+        text = self._pending + text
+        self._pending = ''
+        answer = []
+        reasoning = []
+        pos = 0
+        while pos < len(text):
+            tag = self.CLOSE_TAG if self.in_think else self.OPEN_TAG
+            idx = text.find(tag, pos)
+            if idx == -1:
+                keep = self._partial_tag_length(text, tag, pos)
+                end = len(text) - keep
+                (reasoning if self.in_think else answer).append(text[pos:end])
+                self._pending = text[end:]
+                break
+            (reasoning if self.in_think else answer).append(text[pos:idx])
+            pos = idx + len(tag)
+            if not self.in_think:
+                if self._blocks:
+                    reasoning.append('\n\n')
+                self._blocks += 1
+            self.in_think = not self.in_think
+        return self._answer(''.join(answer)), ''.join(reasoning)
+
+    def flush(self):
+        """流结束时输出残留的不完整标签前缀"""
+        rest = self._pending
+        self._pending = ''
+        if self.in_think:
+            return '', rest
+        return self._answer(rest), ''
+
+    def _answer(self, text):
+        # 去掉推理块之后、回答开始之前的空白
+        if not self._answer_started:
+            text = text.lstrip()
+            self._answer_started = bool(text)
+        return text
+
+# AI提供方适配器：只负责构建请求与解码流式响应，缓冲、推送、推理分离、保存与统计由统一的流式管线处理
+class AIProviderAdapter(ABC):
+    """新增后端时继承该类，实现全部抽象方法（load_config / build_request / models_request / parse_models / decode_line）并登记到 AI_PROVIDER_ADAPTERS；
+    缺少任何一个时创建适配器即报错"""
+    name = None
+    url_key = None  # 未配置节点池时使用的服务地址配置项
+
+    def __init__(self, config):
+        self.config = config
+
+    @classmethod
+    @abstractmethod
+    def load_config(cls):
+        """返回该提供方配置的副本"""
+
+    @property
+    def model(self):
+        return self.config.get('model') or ''
+
+    @property
+    def ai_name(self):
+        return self.config.get('ai_name', 'AI助手')
+
+    @property
+    def supports_reasoning(self):
+        # 是否可能支持“深度思考”（例如 deepseek-r1 等）
+        return any(s in self.model.lower() for s in ('reason', 'deepseek', 'r1'))
+
+    def session(self):
+        settings = http_pool_settings(self.config)
+        return get_http_session(self.name, settings), settings
+
+    def endpoints(self):
+        """节点池：配置的 endpoints，未配置时为单个默认地址
+
+        节点状态按地址记录，手工编辑的配置中重复的地址只保留第一个。
+        """
+        configured = self.config.get('endpoints') or [{'url': self.config.get(self.url_key) or ''}]
+        endpoints = {}
+        for item in configured:
+            endpoint = dict(item, **config_settings(item, AI_ENDPOINT_DEFAULTS))
+            endpoint['url'] = str(endpoint.get('url') or '').rstrip('/')
+            endpoints.setdefault(endpoint['url'], endpoint)
+        return list(endpoints.values())
+
+    @abstractmethod
+    def build_request(self, messages, endpoint):
+        """返回 (url, 传给 Session.post 的关键字参数)"""
+
+    @abstractmethod
+    def models_request(self, endpoint):
+        """列出模型的请求 (url, 传给 Session.get 的关键字参数)，用于连接测试与健康检查"""
+
+    @abstractmethod
+    def parse_models(self, data):
+        """从列出模型的响应中取模型名"""
+
+    def warmup_request(self, endpoint):
+        """预加载模型的请求 (url, 传给 Session.post 的关键字参数)；不需要预热的后端返回 None"""
+        return None
+
+    def warmup_enabled(self):
+        return False
+
+    def resident_seconds(self):
+        """模型空闲后保持加载的秒数；None 表示始终可用（不区分冷启动）"""
+        return None
+
+    def keepalive_interval(self):
+        """保活间隔秒数，0 为不保活"""
+        return 0
+
+    @abstractmethod
+    def decode_line(self, line):
+        """解码一行流式响应，返回 (回答片段, 推理片段, 是否结束)；无法解析时抛出 ValueError"""
+
+class OllamaAdapter(AIProviderAdapter):
+    name = 'ollama'
+    url_key = 'api_url'
+
+    @classmethod
+    def load_config(cls):
+        with ollama_config_lock:
+            return dict(ollama_config)
+
+    def keep_alive_settings(self):
+        return config_settings(self.config, OLLAMA_KEEP_ALIVE_DEFAULTS)
+
+    def build_request(self, messages, endpoint):
+        return f"{endpoint['url']}/api/chat", {
+            'json': {
+                'model': self.model,
+                'messages': messages,
                 'stream': True,
-                'temperature': temperature,
-                'max_tokens': max_tokens
+                'keep_alive': ollama_keep_alive(self.keep_alive_settings()['keep_alive']),
+                'options': {
+                    'temperature': self.config['temperature'],
+                    'num_predict': self.config['max_tokens']
+                }
             }
-            headers = {
-                'Authorization': f'Bearer {api_key}',
+        }
+
+    def models_request(self, endpoint):
+        return f"{endpoint['url']}/api/tags", {}
+
+    def parse_models(self, data):
+        return [m['name'] for m in data.get('models', [])]
+
+    def warmup_request(self, endpoint):
+        # 不带 prompt 的 generate 请求只加载模型
+        return f"{endpoint['url']}/api/generate", {
+            'json': {'model': self.model, 'keep_alive': ollama_keep_alive(self.keep_alive_settings()['keep_alive'])}
+        }
+
+    def warmup_enabled(self):
+        return self.keep_alive_settings()['warmup']
+
+    def resident_seconds(self):
+        return keep_alive_seconds(self.keep_alive_settings()['keep_alive'])
+
+    def keepalive_interval(self):
+        return max(0, self.keep_alive_settings()['keep_alive_ping'])
+
+    def decode_line(self, line):
+        data = json.loads(line.decode('utf-8'))
+        message = data.get('message') or {}
+        # 新版 Ollama 会把推理内容单独放在 thinking 字段
+        return message.get('content') or '', message.get('thinking') or '', bool(data.get('done'))
+
+class OpenAICompatibleAdapter(AIProviderAdapter):
+    """OpenAI 兼容接口（SiliconFlow、DeepSeek 等第三方平台，也适用于 vLLM、llama.cpp server）"""
+    name = 'thirdparty'
+    url_key = 'api_base_url'
+
+    @classmethod
+    def load_config(cls):
+        with third_party_lock:
+            return dict(third_party_ai_config)
+
+    def _api_key(self, endpoint):
+        # 节点可以使用各自的 API Key
+        return endpoint.get('api_key') or self.config.get('api_key')
+
+    def build_request(self, messages, endpoint):
+        return f"{endpoint['url']}/v1/chat/completions", {
+            'headers': {
+                'Authorization': f"Bearer {self._api_key(endpoint)}",
                 'Content-Type': 'application/json'
+            },
+            'json': {
+                'model': self.model,
+                'messages': messages,
+                'stream': True,
+                'temperature': self.config['temperature'],
+                'max_tokens': self.config['max_tokens']
             }
+        }
+
+    def models_request(self, endpoint):
+        return f"{endpoint['url']}/v1/models", {'headers': {'Authorization': f"Bearer {self._api_key(endpoint)}"}}
+
+    def parse_models(self, data):
+        return [m.get('id') for m in data.get('data', [])]
+
+    def decode_line(self, line):
+        line = line.decode('utf-8').strip()
+        # OpenAI流式格式: 以"data: "开头
+        if line.startswith('data:'):
+            line = line[5:].strip()
+        if line == '[DONE]':
+            return '', '', True
+        chunk = json.loads(line)
+        choices = chunk.get('choices') or []
+        if not choices:
+            return '', '', False
+        # 兼容delta流式内容与完整message
+        part = choices[0].get('delta') or choices[0].get('message') or {}
+        # 常见的推理字段：reasoning_content / reasoning / thoughts
+        reasoning = part.get('reasoning_content') or part.get('reasoning') or part.get('thoughts') or ''
+        return part.get('content') or '', reasoning, False
+
+AI_PROVIDER_ADAPTERS = {
+    'ollama': OllamaAdapter,
+    'thirdparty': OpenAICompatibleAdapter
+}
+
+def create_ai_adapter(provider):
+    adapter_class = AI_PROVIDER_ADAPTERS.get(provider, OllamaAdapter)
+    return adapter_class(adapter_class.load_config())
+
+# AI节点池：每个提供方可在配置的 endpoints 中列出多个节点（未配置时使用 api_url / api_base_url），
+# 请求路由到按权重折算后未完成请求最少的健康节点，连接失败或节点过载时自动切换到下一个节点
+AI_ENDPOINT_DEFAULTS = {
+    'weight': 1.0,  # 权重越大分到的请求越多
+    'max_concurrency': 4  # 节点同时处理的请求数，达到上限时优先选择其他节点
+}
+# 健康检查间隔与超时（秒）
+AI_HEALTH_CHECK_INTERVAL = 30
+AI_HEALTH_CHECK_TIMEOUT = 3
+# 连续失败该次数后标记为不健康，由健康检查恢复
+AI_ENDPOINT_MAX_FAILURES = 2
+# 这些上游状态码表示节点过载或故障，换下一个节点重试
+AI_FAILOVER_STATUS = frozenset({429, 500, 502, 503, 504})
+ai_endpoints = {}  # {(provider, url): 节点状态}
+ai_endpoints_lock = Lock()  # 叶子锁，持有期间不进行网络请求
+
+def parse_ai_endpoints(value):
+    """endpoints：[{'url', 'weight', 'max_concurrency', 'api_key'(可选)}]"""
+    endpoints = []
+    for item in value or []:
+        url = str(item.get('url') or '').strip().rstrip('/')
+        if not url:
+            continue
+        # 节点的健康状态与负载按地址记录，地址不能重复
+        if any(endpoint['url'] == url for endpoint in endpoints):
+            raise ValueError(f'节点地址重复: {url}')
+        endpoint = {'url': url, 'weight': float(item.get('weight', 1.0)), 'max_concurrency': int(item.get('max_concurrency', 4))}
+        if endpoint['weight'] <= 0 or endpoint['max_concurrency'] < 1:
+            raise ValueError(f'节点 {url} 的权重与并发上限必须为正数')
+        if item.get('api_key'):
+            endpoint['api_key'] = item['api_key']
+        endpoints.append(endpoint)
+    return endpoints
+
+def _ai_endpoint_state(provider, url):
+    """读取（必要时创建）节点状态（调用者持有 ai_endpoints_lock）"""
+    state = ai_endpoints.get((provider, url))
+    if state is None:
+        state = {
+            'outstanding': 0,
+            'healthy': True,
+            'failures': 0,
+            'requests': 0,
+            'errors': 0,
+            'latencies': deque(maxlen=50),  # 最近请求的响应头延迟（秒）
+            'last_error': None,
+            'last_check': None
+        }
+        ai_endpoints[(provider, url)] = state
+    return state
 
-            full_response = ''
-            response = requests.post(
-                f"{base_url}/v1/chat/completions",
-                headers=headers,
-                json=payload,
-                stream=True,
-                timeout=20
+# 选择节点并占用一个未完成请求名额
+def acquire_ai_endpoint(adapter, exclude=()):
+    """健康且未满的节点优先，其次按 未完成请求数/权重 最小；全部不健康时仍尝试负载最低的节点
+
+    排除已尝试的节点后没有可选节点时抛出 ConnectionError。
+    """
+    endpoints = [endpoint for endpoint in adapter.endpoints() if endpoint['url'] not in exclude]
+    if not endpoints:
+        raise requests.exceptions.ConnectionError('没有可用的AI节点')
+    with ai_endpoints_lock:
+        best = None
+        for endpoint in endpoints:
+            state = _ai_endpoint_state(adapter.name, endpoint['url'])
+            rank = (
+                not state['healthy'],
+                state['outstanding'] >= endpoint['max_concurrency'],
+                state['outstanding'] / endpoint['weight']
             )
+            if best is None or rank < best[0]:
+                best = (rank, endpoint, state)
+        _, endpoint, state = best
+        state['outstanding'] += 1
+        state['requests'] += 1
+    return endpoint
 
-            if response.status_code == 200:
-                buffer = ''
-                chunk_count = 0
-                for raw_line in response.iter_lines():
-                    if not raw_line:
-                        continue
-                    line = raw_line.decode('utf-8')
-                    # OpenAI流式格式: 以"data: "开头
-                    if line.startswith('data: '):
-                        data_str = line[6:].strip()
-                    else:
-                        data_str = line.strip()
-                    if data_str == '[DONE]':
-                        break
-                    try:
-                        chunk_json = json.loads(data_str)
-                        # 兼容delta流式内容
-                        content = ''
-                        if 'choices' in chunk_json and chunk_json['choices']:
-                            choice = chunk_json['choices'][0]
-                            if 'delta' in choice and 'content' in choice['delta']:
-                                content = choice['delta']['content'] or ''
-                            elif 'message' in choice and 'content' in choice['message']:
-                                content = choice['message']['content'] or ''
-                            # 采集可能存在的“深度思考”字段
-                            if supports_reasoning:
-                                # 常见兼容字段：reasoning_content / reasoning / thoughts
-                                rc = ''
-                                if 'delta' in choice:
-                                    rc = choice['delta'].get('reasoning_content') or choice['delta'].get('reasoning') or choice['delta'].get('thoughts') or ''
-                                elif 'message' in choice:
-                                    rc = choice['message'].get('reasoning_content') or choice['message'].get('reasoning') or choice['message'].get('thoughts') or ''
-                                if rc:
-                                    full_reasoning += rc
-                                    # 发送推理片段事件
-                                    socketio.emit('ai_reasoning_chunk', {
-                                        'message_id': message_id,
-                                        'content': rc
-                                    }, room=room)
-                                    # 让事件及时刷新到客户端，避免被后续块吞并
-                                    socketio.sleep(0.01)
-                                else:
-                                    # 若未提供显式推理字段，尝试从文本内容中提取<think>…</think>
-                                    try:
-                                        import re
-                                        combined = full_response + (content or '')
-                                        thinks = re.findall(r"<think>([\s\S]*?)</think>", combined)
-                                        if thinks:
-                                            joined = "\n\n".join(thinks)
-                                            if len(joined) > len(full_reasoning):
-                                                new_part = joined[len(full_reasoning):]
-                                                if new_part.strip():
-                                                    full_reasoning = joined
-                                                    socketio.emit('ai_reasoning_chunk', {
-                                                        'message_id': message_id,
-                                                        'content': new_part
-                                                    }, room=room)
-                                                    # 让事件及时刷新到客户端
-                                                    socketio.sleep(0.01)
-                                    except Exception:
-                                        pass
-                        if content:
-                            full_response += content
-                            buffer += content
-                            chunk_count += 1
-                            if len(buffer) >= 5 or chunk_count >= 3:
-                                socketio.emit('ai_response_chunk', {
-                                    'message_id': message_id,
-                                    'content': buffer
-                                }, room=room)
-                                buffer = ''
-                                chunk_count = 0
-                                socketio.sleep(0.01)
-                    except json.JSONDecodeError:
-                        continue
-
-                if buffer:
-                    socketio.emit('ai_response_chunk', {
-                        'message_id': message_id,
-                        'content': buffer
-                    }, room=room)
-
-                socketio.emit('ai_response_end', {'message_id': message_id}, room=room)
-
-                # 结束时，如果有采集到推理内容，发送推理结束事件（用于一次性显示完整内容）
-                if supports_reasoning and full_reasoning:
-                    socketio.emit('ai_reasoning_end', {
-                        'message_id': message_id,
-                        'content': full_reasoning
-                    }, room=room)
-
-                ai_message_obj = {
-                    'username': ai_name,
-                    'message': full_response,
-                    'type': 'ai',
-                    'timestamp': timestamp,
-                    'message_id': message_id
-                }
-                try:
-                    with history_lock:
-                        if room in room_history:
-                            room_history[room]['messages'].append(ai_message_obj)
-                            room_history[room]['last_active'] = datetime.now()
-                            if len(room_history[room]['messages']) % 10 == 0:
-                                save_history()
-                except Exception as e:
-                    print(f"保存AI消息历史失败: {e}")
-                # 成功计数+1
-                with ai_stats_lock:
-                    ai_request_success += 1
-                notify_admin_update('stats')
-            else:
-                socketio.emit('ai_response_error', {
-                    'message_id': message_id,
-                    'error': f'AI响应失败: HTTP {response.status_code}'
-                }, room=room)
-                notify_admin_update('stats')
+def record_ai_endpoint_latency(provider, endpoint, latency):
+    with ai_endpoints_lock:
+        _ai_endpoint_state(provider, endpoint['url'])['latencies'].append(latency)
+
+# 释放名额并记录结果
+def release_ai_endpoint(provider, endpoint, error=None):
+    with ai_endpoints_lock:
+        state = _ai_endpoint_state(provider, endpoint['url'])
+        state['outstanding'] = max(0, state['outstanding'] - 1)
+        if error is None:
+            state['failures'] = 0
+            state['healthy'] = True
+            return
+        state['errors'] += 1
+        state['failures'] += 1
+        state['last_error'] = str(error)[:200]
+        if state['failures'] >= AI_ENDPOINT_MAX_FAILURES:
+            state['healthy'] = False
+
+# 向节点池发起流式请求
+def post_ai_request(adapter, messages):
+    """按路由策略选择节点，连接失败或节点过载时切换到下一个节点
+
+    返回 (response, endpoint)；调用者读取完毕后调用 release_ai_endpoint 释放节点。
+    所有节点都连接失败时抛出最后一次的异常。
+    """
+    http_session, http_settings = adapter.session()
+    endpoint_count = len(adapter.endpoints())
+    tried = []
+    while True:
+        endpoint = acquire_ai_endpoint(adapter, tried)
+        tried.append(endpoint['url'])
+        url, request_kwargs = adapter.build_request(messages, endpoint)
+        started = time.time()
+        try:
+            response = http_session.post(url, stream=True, timeout=http_timeout(http_settings), **request_kwargs)
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            release_ai_endpoint(adapter.name, endpoint, e)
+            if len(tried) >= endpoint_count:
+                raise
+            continue
+        if response.status_code in AI_FAILOVER_STATUS and len(tried) < endpoint_count:
+            response.close()
+            release_ai_endpoint(adapter.name, endpoint, f'HTTP {response.status_code}')
+            continue
+        record_ai_endpoint_latency(adapter.name, endpoint, time.time() - started)
+        return response, endpoint
 
+# 探测单个节点（与管理面板的连接测试相同：列出模型）
+def probe_ai_endpoint(adapter, endpoint):
+    http_session, http_settings = adapter.session()
+    url, request_kwargs = adapter.models_request(endpoint)
+    error = None
+    try:
+        response = http_session.get(url, timeout=(http_settings['connect_timeout'], AI_HEALTH_CHECK_TIMEOUT), **request_kwargs)
+        if response.status_code != 200:
+            error = f'HTTP {response.status_code}'
+        response.close()
+    except Exception as e:
+        error = str(e)[:200]
+    with ai_endpoints_lock:
+        state = _ai_endpoint_state(adapter.name, endpoint['url'])
+        state['healthy'] = error is None
+        state['last_check'] = datetime.now()
+        if error is None:
+            state['failures'] = 0
         else:
-            # 默认使用Ollama
-            with ollama_config_lock:
-                api_url = ollama_config['api_url']
-                model = ollama_config['model']
-                temperature = ollama_config['temperature']
-                max_tokens = ollama_config['max_tokens']
-                system_prompt = ollama_config['system_prompt']
-                default_ai_name = ollama_config.get('ai_name', 'AI助手')
-            ai_name = custom_ai_name if custom_ai_name else default_ai_name
+            state['last_error'] = error
+    return error is None
+
+# 后台健康检查线程：探测当前提供方的所有节点，并清理已从配置中移除的节点
+def ai_health_worker():
+    while True:
+        socketio.sleep(AI_HEALTH_CHECK_INTERVAL)
+        try:
+            with ai_provider_lock:
+                provider = ai_provider
+            adapter = create_ai_adapter(provider)
+            if not adapter.config.get('enabled'):
+                continue
+            endpoints = adapter.endpoints()
+            for endpoint in endpoints:
+                probe_ai_endpoint(adapter, endpoint)
+            configured = {(provider, endpoint['url']) for endpoint in endpoints}
+            with ai_endpoints_lock:
+                for key in [key for key in ai_endpoints if key[0] == provider and key not in configured]:
+                    if ai_endpoints[key]['outstanding'] == 0:
+                        del ai_endpoints[key]
+        except Exception as e:
+            print(f"AI节点健康检查失败: {e}")
+
+def get_ai_endpoint_stats():
+    with ai_endpoints_lock:
+        items = [(key, dict(state, latencies=list(state['latencies']))) for key, state in ai_endpoints.items()]
+    stats = []
+    for (provider, url), state in sorted(items):
+        latencies = state.pop('latencies')
+        last_check = state['last_check']
+        state.update({
+            'provider': provider,
+            'url': url,
+            'avg_latency_ms': round(sum(latencies) / len(latencies) * 1000, 1) if latencies else 0.0,
+            'last_check': last_check.strftime('%Y-%m-%d %H:%M:%S') if last_check else None
+        })
+        stats.append(state)
+    return stats
+
+# 模型预热与保活：Ollama 空闲一段时间后会卸载模型，下一次请求要在超时时间内等待模型加载。
+# 启动时与修改模型配置后预加载模型，请求都带上 keep_alive；有房间正在使用 AI 时定期发送空请求保持模型驻留
+OLLAMA_KEEP_ALIVE_DEFAULTS = {
+    'keep_alive': '30m',  # 模型驻留时间（Ollama 的 keep_alive，如 300、'30m'、'-1' 为常驻）
+    'warmup': True,  # 启动与修改模型配置后预加载模型
+    'keep_alive_ping': 240  # 保活间隔（秒），0 为关闭
+}
+# 预热请求的读取超时（秒），需要覆盖加载大模型的时间
+AI_WARMUP_TIMEOUT = 300
+# 保活线程检查间隔（秒）
+AI_KEEPALIVE_CHECK_INTERVAL = 60
+# 房间在最近该时间内发送过开启 AI 的消息时视为活跃（秒）
+AI_ACTIVE_ROOM_WINDOW = 1800
+OLLAMA_DURATION_RE = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+OLLAMA_DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+ai_model_residency = {}  # {(provider, url, model): 最近一次使用模型的时间}
+ai_room_activity = {}  # {room: 最近一次开启 AI 的消息时间}
+ai_warmup_lock = Lock()  # 叶子锁
+ai_warmup_stats = {'warmups': 0, 'pings': 0, 'failed': 0, 'last_warmup_ms': 0.0, 'last_warmup': None}
+ai_ttft_stats = {'cold': [0, 0.0], 'warm': [0, 0.0]}  # {类别: [次数, 首字总耗时秒]}，由 ai_stats_lock 保护
+
+def ollama_keep_alive(value):
+    """keep_alive 参数：纯数字按秒数发送，其余按 Ollama 的时长字符串发送"""
+    value = str(value).strip()
+    try:
+        return int(float(value))
+    except ValueError:
+        return value
+
+def keep_alive_seconds(value):
+    """keep_alive 转为秒数；负数表示常驻"""
+    value = ollama_keep_alive(value)
+    if isinstance(value, int):
+        return math.inf if value < 0 else value
+    if value.startswith('-'):
+        return math.inf
+    return sum(float(amount) * OLLAMA_DURATION_UNITS[unit] for amount, unit in OLLAMA_DURATION_RE.findall(value))
+
+def note_ai_room_activity(room):
+    with ai_warmup_lock:
+        ai_room_activity[room] = time.time()
+
+def ai_rooms_active():
+    """是否有在线成员、且最近使用过 AI 的房间"""
+    cutoff = time.time() - AI_ACTIVE_ROOM_WINDOW
+    with ai_warmup_lock:
+        for room in [room for room, last in ai_room_activity.items() if last < cutoff]:
+            del ai_room_activity[room]
+        rooms = list(ai_room_activity)
+    return any(room_members.get(room) for room in rooms)
+
+# 记录一次模型使用，返回使用前模型是否仍驻留
+def touch_ai_model(adapter, endpoint):
+    resident = adapter.resident_seconds()
+    if resident is None:
+        return True
+    key = (adapter.name, endpoint['url'], adapter.model)
+    now = time.time()
+    with ai_warmup_lock:
+        last_used = ai_model_residency.get(key)
+        ai_model_residency[key] = now
+    return last_used is not None and now - last_used < resident
+
+def ai_model_idle_seconds(adapter, endpoint):
+    with ai_warmup_lock:
+        last_used = ai_model_residency.get((adapter.name, endpoint['url'], adapter.model))
+    return None if last_used is None else time.time() - last_used
+
+def record_ai_first_token(warm, seconds):
+    with ai_stats_lock:
+        entry = ai_ttft_stats['warm' if warm else 'cold']
+        entry[0] += 1
+        entry[1] += seconds
+
+# 预热或保活：向节点发送不生成内容的请求，使模型加载并重新计算驻留时间
+def warm_ai_model(adapter, endpoint, ping=False):
+    request = adapter.warmup_request(endpoint)
+    if request is None:
+        return True
+    url, request_kwargs = request
+    http_session, http_settings = adapter.session()
+    started = time.time()
+    try:
+        response = http_session.post(url, timeout=(http_settings['connect_timeout'], AI_WARMUP_TIMEOUT), **request_kwargs)
+        response.close()
+        ok = response.status_code == 200
+    except Exception as e:
+        print(f"AI模型预热失败 ({endpoint['url']}): {e}")
+        ok = False
+    elapsed = time.time() - started
+    if ok:
+        touch_ai_model(adapter, endpoint)
+    with ai_warmup_lock:
+        if not ok:
+            ai_warmup_stats['failed'] += 1
+        elif ping:
+            ai_warmup_stats['pings'] += 1
+        else:
+            ai_warmup_stats['warmups'] += 1
+            ai_warmup_stats['last_warmup_ms'] = elapsed * 1000
+            ai_warmup_stats['last_warmup'] = datetime.now()
+    return ok
+
+def warm_current_ai_model():
+    """预加载当前提供方的模型（提供方不需要预热或已关闭预热时跳过）"""
+    with ai_provider_lock:
+        provider = ai_provider
+    adapter = create_ai_adapter(provider)
+    if not adapter.config.get('enabled') or not adapter.warmup_enabled():
+        return
+    for endpoint in adapter.endpoints():
+        warm_ai_model(adapter, endpoint)
+
+def schedule_ai_warmup():
+    socketio.start_background_task(warm_current_ai_model)
+
+# 后台保活线程：启动时预热一次，之后在有活跃 AI 房间时按间隔保活
+def ai_keepalive_worker():
+    warm_current_ai_model()
+    while True:
+        socketio.sleep(AI_KEEPALIVE_CHECK_INTERVAL)
+        try:
+            with ai_provider_lock:
+                provider = ai_provider
+            adapter = create_ai_adapter(provider)
+            interval = adapter.keepalive_interval()
+            if not adapter.config.get('enabled') or not interval or not ai_rooms_active():
+                continue
+            for endpoint in adapter.endpoints():
+                idle = ai_model_idle_seconds(adapter, endpoint)
+                if idle is None or idle >= interval:
+                    warm_ai_model(adapter, endpoint, ping=True)
+        except Exception as e:
+            print(f"AI模型保活失败: {e}")
+
+def get_ai_warmup_stats():
+    with ai_warmup_lock:
+        stats = dict(ai_warmup_stats)
+        stats['active_rooms'] = len(ai_room_activity)
+    with ai_stats_lock:
+        ttft = {kind: list(entry) for kind, entry in ai_ttft_stats.items()}
+    for kind, (count, total) in ttft.items():
+        stats[f'{kind}_requests'] = count
+        stats[f'{kind}_ttft_ms'] = round(total / count * 1000, 1) if count else 0.0
+    last_warmup = stats['last_warmup']
+    stats['last_warmup'] = last_warmup.strftime('%Y-%m-%d %H:%M:%S') if last_warmup else None
+    stats['last_warmup_ms'] = round(stats['last_warmup_ms'], 1)
+    return stats
+
+# 给系统提示追加上下文格式说明
+AI_CONTEXT_NOTE = (
+    f"\n\n注意：你将收到一段最近的对话上下文（最多{AI_CONTEXT_MAX_ITEMS}条）。其中：\n" +
+    "- 用户消息采用格式：【昵称】消息文本\n" +
+    "- AI消息为纯文本，不包含昵称前缀\n" +
+    f"- 以{AI_SUMMARY_CONTEXT_PREFIX}开头的系统消息是更早聊天内容的摘要\n" +
+    f"- 以{AI_RETRIEVAL_CONTEXT_PREFIX}开头的系统消息是从更早历史中检索到的与当前问题相关的消息\n" +
+    "请在理解上下文时正确区分不同用户的昵称，保持回答简洁友好。"
+)
+
+# 上下文 token 预算：按提供方配置，可在 model_context_tokens 中按模型覆盖上下文窗口
+AI_CONTEXT_BUDGET_DEFAULTS = {
+    'context_tokens': 4096,  # 模型上下文窗口，应与模型实际窗口（如 Ollama 的 num_ctx）一致
+    'context_message_tokens': 512,  # 单条上下文消息的上限
+    'context_truncation': 'head'  # 超长消息的处理：head 保留开头，tail 保留结尾，drop 整条丢弃
+}
+AI_CONTEXT_TRUNCATION_POLICIES = ('head', 'tail', 'drop')
+# 窗口扣除回答长度（max_tokens）后留给提示的最少 token 数
+AI_MIN_PROMPT_TOKENS = 256
+# 每条消息的角色与分隔符开销
+AI_MESSAGE_TOKEN_OVERHEAD = 4
+# 中日韩文字与全角符号：大致一个字一个 token；其他文字大致 4 个字符一个 token
+CJK_CHAR_RE = re.compile(r'[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]')
+
+def estimate_tokens(text):
+    """快速估算 token 数（不依赖分词器）"""
+    cjk = len(CJK_CHAR_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+def _token_prefix_length(text, max_tokens):
+    """估算 token 数不超过 max_tokens 的最长前缀长度"""
+    budget = max_tokens * 4
+    for i, ch in enumerate(text):
+        budget -= 4 if CJK_CHAR_RE.match(ch) else 1
+        if budget < 0:
+            return i
+    return len(text)
+
+def truncate_to_tokens(text, max_tokens, policy='head'):
+    """按策略把文本截到 max_tokens 以内；drop 策略或预算不足时返回 None"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    if policy == 'drop' or max_tokens <= 1:
+        return None
+    # 省略号本身占一个 token
+    if policy == 'tail':
+        return '…' + text[len(text) - _token_prefix_length(text[::-1], max_tokens - 1):]
+    return text[:_token_prefix_length(text, max_tokens - 1)] + '…'
+
+def ai_context_budget(config, model=''):
+    """返回本次请求的预算：提示可用 token 数、单条消息上限与截断策略"""
+    settings = config_settings(config, AI_CONTEXT_BUDGET_DEFAULTS)
+    overrides = config.get('model_context_tokens') or {}
+    if model in overrides:
+        try:
+            settings['context_tokens'] = int(overrides[model])
+        except (TypeError, ValueError):
+            pass
+    if settings['context_truncation'] not in AI_CONTEXT_TRUNCATION_POLICIES:
+        settings['context_truncation'] = 'head'
+    try:
+        reserved = int(config.get('max_tokens', 0))
+    except (TypeError, ValueError):
+        reserved = 0
+    settings['prompt_tokens'] = max(settings['context_tokens'] - reserved, AI_MIN_PROMPT_TOKENS)
+    return settings
+
+def build_ai_messages(room, config, user_message, model=''):
+    """构建请求消息：系统提示 + 预算内的最近上下文 + 当前问题，返回 (messages, 估算的提示 token 数)
+
+    依次装入滚动摘要（最多占剩余预算的一半）、检索到的相关历史（最多占剩余预算的四分之一）与最近上下文；
+    最近上下文从最新一条开始装入，超过单条上限的消息按截断策略处理，装不下时停止，更早的消息不再发送。
+    """
+    budget = ai_context_budget(config, model)
+    system = {'role': 'system', 'content': (config.get('system_prompt') or '') + AI_CONTEXT_NOTE}
+    question = {'role': 'user', 'content': user_message}
+    used = estimate_tokens(system['content']) + estimate_tokens(user_message) + 2 * AI_MESSAGE_TOKEN_OVERHEAD
+    window = build_ai_context_messages(room)
+    summary = None
+    if window and window[0]['role'] == 'system':
+        # 滚动摘要优先装入，最多占剩余预算的一半
+        content = truncate_to_tokens(window.pop(0)['content'], (budget['prompt_tokens'] - used) // 2)
+        if content:
+            summary = {'role': 'system', 'content': content}
+            used += estimate_tokens(content) + AI_MESSAGE_TOKEN_OVERHEAD
+    related = None
+    retrieval_k = config_settings(config, AI_RETRIEVAL_DEFAULTS)['context_retrieval_k']
+    if retrieval_k > 0:
+        limit = (budget['prompt_tokens'] - used) // 4
+        lines = []
+        tokens = estimate_tokens(AI_RETRIEVAL_CONTEXT_PREFIX) + AI_MESSAGE_TOKEN_OVERHEAD
+        for role, username, timestamp, text in retrieve_room_messages(room, user_message, retrieval_k):
+            speaker = AI_SUMMARY_ASSISTANT_LABEL if role == 'assistant' else username
+            text = truncate_to_tokens(text, budget['context_message_tokens'])
+            line = f"【{time.strftime('%Y-%m-%d %H:%M', time.localtime(timestamp))}】【{speaker}】{text}"
+            line_tokens = estimate_tokens(line) + 1
+            if tokens + line_tokens > limit:
+                break
+            tokens += line_tokens
+            lines.append(line)
+        if lines:
+            related = {'role': 'system', 'content': AI_RETRIEVAL_CONTEXT_PREFIX + '\n' + '\n'.join(lines)}
+            used += tokens
+    context = []
+    truncated = 0
+    for message in reversed(window):
+        content = truncate_to_tokens(message['content'], budget['context_message_tokens'], budget['context_truncation'])
+        if content is None:
+            continue
+        tokens = estimate_tokens(content) + AI_MESSAGE_TOKEN_OVERHEAD
+        if used + tokens > budget['prompt_tokens']:
+            break
+        if content is not message['content']:
+            truncated += 1
+        used += tokens
+        context.append({'role': message['role'], 'content': content})
+    context.reverse()
+    record_ai_prompt(used, truncated, len(window) - len(context))
+    if related is not None:
+        context.insert(0, related)
+    if summary is not None:
+        context.insert(0, summary)
+    return [system] + context + [question], used
+
+def record_ai_prompt(tokens, truncated, dropped):
+    with ai_stats_lock:
+        ai_prompt_tokens.append(tokens)
+        ai_prompt_stats['requests'] += 1
+        ai_prompt_stats['truncated_messages'] += truncated
+        ai_prompt_stats['dropped_messages'] += dropped
+
+def get_ai_prompt_stats():
+    with ai_stats_lock:
+        stats = dict(ai_prompt_stats)
+        recent = list(ai_prompt_tokens)
+    stats['last_tokens'] = recent[-1] if recent else 0
+    stats['avg_tokens'] = round(sum(recent) / len(recent)) if recent else 0
+    stats['peak_tokens'] = max(recent) if recent else 0
+    return stats
+
+# AI回答缓存（默认关闭）：繁忙房间里常有多人在几秒内发出相同的短问题（“你好”“帮助”）
+# 开启后相同请求直接回放缓存的回答，正在生成的相同请求挂到同一个上游流上，不再重复调用后端
+# 可在 ollama_config / third_party_ai_config 中开启并调整缓存时间
+AI_RESPONSE_CACHE_DEFAULTS = {
+    'response_cache': False,
+    'response_cache_ttl': 300  # 回答缓存时间（秒）
+}
+AI_RESPONSE_CACHE_SIZE = 200
+ai_response_cache = OrderedDict()  # {key: (expires_at, answer, reasoning)}
+ai_response_streams = {}  # {key: AIResponseStream} 正在生成、可供相同请求挂靠的流
+ai_response_cache_lock = Lock()  # 持有期间只会再获取流的锁
+ai_response_cache_stats = {'hits': 0, 'misses': 0, 'coalesced': 0}
+# 上下文中用户消息的昵称前缀
+AI_CONTEXT_SPEAKER_RE = re.compile(r'^【[^】]*】')
+
+def parse_model_context_tokens(value):
+    """model_context_tokens：{模型名: 上下文窗口}"""
+    return {str(model): int(tokens) for model, tokens in (value or {}).items()}
 
-            # 标记是否可能支持“深度思考”（例如 deepseek-r1 等会输出<think>内容）
-            supports_reasoning = any(s in (model or '').lower() for s in ['reason', 'deepseek', 'r1'])
-            full_reasoning = ''
+def ai_response_cache_settings(config):
+    return config_settings(config, AI_RESPONSE_CACHE_DEFAULTS)
 
+def ai_context_digest(context_messages, user_message):
+    """上下文摘要；末尾与本次问题相同的用户消息就是并发的相同请求本身，不计入摘要"""
+    end = len(context_messages)
+    while end:
+        message = context_messages[end - 1]
+        if message['role'] != 'user' or AI_CONTEXT_SPEAKER_RE.sub('', message['content'], count=1) != user_message:
+            break
+        end -= 1
+    payload = json.dumps(context_messages[:end], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def ai_response_cache_key(adapter, messages, user_message):
+    """缓存键：提供方、模型、系统提示、上下文摘要与问题
+
+    上下文包含此前的 AI 回答，同一房间里 AI 回答之后重复的问题不会命中，缓存主要合并同时发出的相同问题。
+    """
+    payload = json.dumps([
+        adapter.name,
+        adapter.model,
+        messages[0]['content'],
+        ai_context_digest(messages[1:-1], user_message),
+        user_message
+    ], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def _lookup_ai_response(key):
+    """读取未过期的缓存回答（调用者持有 ai_response_cache_lock）"""
+    entry = ai_response_cache.get(key)
+    if entry is None:
+        return None
+    if entry[0] <= time.time():
+        del ai_response_cache[key]
+        return None
+    ai_response_cache.move_to_end(key)
+    return entry[1], entry[2]
+
+def get_ai_response_cache_stats():
+    with ai_response_cache_lock:
+        stats = dict(ai_response_cache_stats)
+        stats['size'] = len(ai_response_cache)
+        stats['inflight'] = len(ai_response_streams)
+    lookups = stats['hits'] + stats['misses'] + stats['coalesced']
+    served = stats['hits'] + stats['coalesced']
+    stats['hit_rate'] = f"{(served / lookups * 100.0) if lookups else 0.0:.1f}%"
+    return stats
+
+# 一次上游生成的推送目标：通常只有发起者，开启回答缓存后相同请求的后来者也订阅同一个流
+class AIResponseStream:
+    """把流式事件逐个推送给订阅者，并记录已推送的回答与推理，供中途加入的订阅者补齐
+
+    推送在流的锁内进行，保证补齐内容与后续片段的先后顺序；
+    所有订阅者都取消后设置 cancelled 并关闭上游连接。
+    """
+
+    def __init__(self, supports_reasoning, cancelled=None, key=None, cache_ttl=0):
+        self.supports_reasoning = supports_reasoning
+        self.cancelled = cancelled or create_event()
+        self.key = key  # 回答缓存键，未开启缓存时为 None
+        self.cache_ttl = cache_ttl
+        self.finished = False
+        self.lock = Lock()
+        self.subscribers = []  # [{'room', 'message_id', 'ai_name', 'created_at'}]
+        self.answer = ''  # 已推送的回答
+        self.reasoning = ''  # 已推送的推理
+        self.response = None
+        # 待推送的回答与推理：按时间或字节数合并后一次推送
+        self.pending_answer = ''
+        self.pending_reasoning = ''
+        self.pending_bytes = 0
+        self.flush_interval, self.flush_bytes = AI_CHUNK_FLUSH_TIERS[-1][1:]
+        self.last_flush = time.monotonic()
+        self.reading = False
+
+    def subscribe(self, subscriber):
+        """加入订阅并推送开始事件与已生成的内容；流已取消或请求已被取消时返回 False"""
+        with self.lock:
+            if self.finished or self.cancelled.is_set():
+                return False
+            message_id = subscriber['message_id']
+            # 与取消登记表原子地关联，之后对该请求的取消交给本流处理
+            with ai_generations_lock:
+                generation = ai_generations.get(message_id)
+                if generation is not None:
+                    if generation['cancelled'].is_set():
+                        return False
+                    generation['stream'] = self
+            self.subscribers.append(subscriber)
             socketio.emit('ai_response_start', {
                 'message_id': message_id,
-                'timestamp': timestamp,
-                'ai_name': ai_name,
-                'supports_reasoning': supports_reasoning
-            }, room=room)
-            socketio.sleep(0.1)
-
-            augmented_system_prompt = (
-                (system_prompt or '') +
-                "\n\n注意：你将收到一段最近的对话上下文（最多20条）。其中：\n" +
-                "- 用户消息采用格式：【昵称】消息文本\n" +
-                "- AI消息为纯文本，不包含昵称前缀\n" +
-                "请在理解上下文时正确区分不同用户的昵称，保持回答简洁友好。"
-            )
-            payload = {
-                'model': model,
-                'messages': (
-                    [{'role': 'system', 'content': augmented_system_prompt}] +
-                    build_ai_context_messages(room, max_items=20) +
-                    [{'role': 'user', 'content': user_message}]
-                ),
-                'stream': True,
-                'options': {
-                    'temperature': temperature,
-                    'num_predict': max_tokens
-                }
-            }
+                'timestamp': time.strftime(TIMESTAMP_FORMAT, time.localtime(subscriber['created_at'])),
+                'ai_name': subscriber['ai_name'],
+                'supports_reasoning': self.supports_reasoning
+            }, room=subscriber['room'])
+            if self.reasoning:
+                socketio.emit('ai_reasoning_chunk', {'message_id': message_id, 'content': self.reasoning}, room=subscriber['room'])
+            if self.answer:
+                socketio.emit('ai_response_chunk', {'message_id': message_id, 'content': self.answer}, room=subscriber['room'])
+        return True
 
-            full_response = ''
-            response = requests.post(
-                f"{api_url}/api/chat",
-                json=payload,
-                stream=True,
-                timeout=15
-            )
+    def catch_up(self, room, sid):
+        """向中途加入房间的连接一次性推送本房间各订阅者已生成的内容，之后的片段由房间广播送达"""
+        with self.lock:
+            for subscriber in self.subscribers:
+                if subscriber['room'] != room:
+                    continue
+                socketio.emit('ai_response_catchup', {
+                    'message_id': subscriber['message_id'],
+                    'timestamp': time.strftime(TIMESTAMP_FORMAT, time.localtime(subscriber['created_at'])),
+                    'ai_name': subscriber['ai_name'],
+                    'supports_reasoning': self.supports_reasoning,
+                    'content': self.answer,
+                    'reasoning': self.reasoning
+                }, room=sid)
 
-            if response.status_code == 200:
-                buffer = ''
-                chunk_count = 0
-                for line in response.iter_lines():
-                    if line:
-                        try:
-                            chunk_data = json.loads(line.decode('utf-8'))
-                            if 'message' in chunk_data and 'content' in chunk_data['message']:
-                                content = chunk_data['message']['content']
-                                full_response += content
-                                buffer += content
-                                chunk_count += 1
-                                # 若模型输出<think>...</think>，提取作为“深度思考”内容
-                                if supports_reasoning and content:
-                                    try:
-                                        txt = str(content)
-                                        # 提取所有<think>...</think>内容（可能跨chunk累积）
-                                        # 简易策略：基于累计的full_response提取，再与已有的full_reasoning比较
-                                        combined = full_response
-                                        import re
-                                        thinks = re.findall(r"<think>([\s\S]*?)</think>", combined)
-                                        if thinks:
-                                            joined = "\n\n".join(thinks)
-                                            if len(joined) > len(full_reasoning):
-                                                new_part = joined[len(full_reasoning):]
-                                                if new_part.strip():
-                                                    full_reasoning = joined
-                                                    socketio.emit('ai_reasoning_chunk', {
-                                                        'message_id': message_id,
-                                                        'content': new_part
-                                                    }, room=room)
-                                                    # 及时将推理片段送达客户端
-                                                    socketio.sleep(0.01)
-                                    except Exception:
-                                        pass
-                                if len(buffer) >= 5 or chunk_count >= 3:
-                                    socketio.emit('ai_response_chunk', {
-                                        'message_id': message_id,
-                                        'content': buffer
-                                    }, room=room)
-                                    buffer = ''
-                                    chunk_count = 0
-                                    socketio.sleep(0.01)
-                        except json.JSONDecodeError:
-                            continue
-                if buffer:
-                    socketio.emit('ai_response_chunk', {
-                        'message_id': message_id,
-                        'content': buffer
-                    }, room=room)
-                socketio.emit('ai_response_end', {'message_id': message_id}, room=room)
-
-                # 结束时，如果有采集到推理内容，发送推理结束事件
-                if supports_reasoning and full_reasoning:
-                    socketio.emit('ai_reasoning_end', {
-                        'message_id': message_id,
-                        'content': full_reasoning
-                    }, room=room)
-
-                ai_message_obj = {
-                    'username': ai_name,
-                    'message': full_response,
-                    'type': 'ai',
-                    'timestamp': timestamp,
-                    'message_id': message_id
-                }
-                try:
-                    with history_lock:
-                        if room in room_history:
-                            room_history[room]['messages'].append(ai_message_obj)
-                            room_history[room]['last_active'] = datetime.now()
-                            if len(room_history[room]['messages']) % 10 == 0:
-                                save_history()
-                except Exception as e:
-                    print(f"保存AI消息历史失败: {e}")
-                # 成功计数+1
-                with ai_stats_lock:
-                    ai_request_success += 1
-                notify_admin_update('stats')
-            else:
+    def _emit(self, event, payload):
+        # 调用者持有 self.lock
+        for subscriber in self.subscribers:
+            socketio.emit(event, dict(payload, message_id=subscriber['message_id']), room=subscriber['room'])
+
+    def _emit_chunk(self, event, content):
+        # 调用者持有 self.lock
+        self._emit(event, {'content': content})
+        record_ai_chunk_emit(len(self.subscribers), len(content.encode('utf-8')))
+
+    def send_answer(self, content):
+        with self.lock:
+            self.answer += content
+            self._emit_chunk('ai_response_chunk', content)
+
+    def send_reasoning(self, content):
+        with self.lock:
+            self.reasoning += content
+            self._emit_chunk('ai_reasoning_chunk', content)
+
+    def buffer(self, answer, reasoning):
+        """缓冲片段；距上次推送超过间隔或积累足够字节时立即推送，返回是否已推送"""
+        with self.lock:
+            self.pending_answer += answer
+            self.pending_reasoning += reasoning
+            self.pending_bytes += len(answer.encode('utf-8')) + len(reasoning.encode('utf-8'))
+            if not self.pending_bytes:
+                return False
+            # 慢速模型的每个片段都会立即推送
+            if time.monotonic() - self.last_flush < self.flush_interval and self.pending_bytes < self.flush_bytes:
+                return False
+            self._flush()
+        return True
+
+    def flush(self):
+        """推送全部缓冲内容"""
+        with self.lock:
+            if self.pending_bytes:
+                self._flush()
+
+    def _flush(self):
+        # 调用者持有 self.lock
+        if self.pending_reasoning:
+            self.reasoning += self.pending_reasoning
+            self._emit_chunk('ai_reasoning_chunk', self.pending_reasoning)
+        if self.pending_answer:
+            self.answer += self.pending_answer
+            self._emit_chunk('ai_response_chunk', self.pending_answer)
+        self.pending_answer = ''
+        self.pending_reasoning = ''
+        self.pending_bytes = 0
+        self.last_flush = time.monotonic()
+
+    def start_flushing(self, interval, max_bytes):
+        """设置合并策略并启动定时推送：上游暂停时，缓冲内容最迟在合并间隔后推送"""
+        with self.lock:
+            self.flush_interval = interval
+            self.flush_bytes = max_bytes
+            self.last_flush = time.monotonic()
+            self.reading = True
+        socketio.start_background_task(self._flush_on_deadline)
+
+    def stop_flushing(self):
+        with self.lock:
+            self.reading = False
+
+    def _flush_on_deadline(self):
+        while True:
+            with self.lock:
+                if not self.reading:
+                    return
+                delay = self.last_flush + self.flush_interval - time.monotonic()
+                if delay <= 0:
+                    if self.pending_bytes:
+                        self._flush()
+                    delay = self.flush_interval
+            socketio.sleep(delay)
+
+    def audience_size(self):
+        """订阅房间的在线人数之和（决定推送合并策略）"""
+        with self.lock:
+            rooms = {subscriber['room'] for subscriber in self.subscribers}
+        size = 0
+        for room in rooms:
+            with room_lock(room):
+                room_data = room_history.get(room)
+                if room_data is not None:
+                    size += len(room_data['users'])
+        return size
+
+    def attach_response(self, response):
+        """登记上游响应；若在请求期间已全部取消则立即关闭"""
+        with self.lock:
+            self.response = response
+            if not self.cancelled.is_set():
+                return
+        response.close()
+
+    def cancel(self, message_id):
+        """取消一个订阅者：保存其已收到的部分回答；没有订阅者时停止上游"""
+        response = None
+        with self.lock:
+            subscriber = next((s for s in self.subscribers if s['message_id'] == message_id), None)
+            if subscriber is None:
+                return
+            self.subscribers.remove(subscriber)
+            answer = self.answer
+            socketio.emit('ai_response_cancelled', {'message_id': message_id}, room=subscriber['room'])
+            if not self.subscribers:
+                self.cancelled.set()
+                response = self.response
+        unregister_ai_generation(message_id)
+        # 已经推送给用户的部分回答仍然保存到历史
+        if answer:
+            save_ai_message(subscriber, answer)
+        if response is not None:
+            try:
+                response.close()
+            except Exception:
+                pass
+
+    def fail(self, error):
+        """向所有订阅者推送错误并结束"""
+        with self.lock:
+            self.finished = True
+            subscribers, self.subscribers = self.subscribers, []
+            for subscriber in subscribers:
                 socketio.emit('ai_response_error', {
-                    'message_id': message_id,
-                    'error': f'AI响应失败: HTTP {response.status_code}'
-                }, room=room)
-                notify_admin_update('stats')
+                    'message_id': subscriber['message_id'],
+                    'error': error
+                }, room=subscriber['room'])
+        for subscriber in subscribers:
+            unregister_ai_generation(subscriber['message_id'])
 
-    except requests.exceptions.Timeout:
-        socketio.emit('ai_response_error', {
-            'message_id': message_id,
-            'error': 'AI响应超时，请检查后台服务是否正常'
-        }, room=room)
+    def finish(self):
+        """推送结束事件，返回仍在订阅的请求"""
+        with self.lock:
+            self.finished = True
+            subscribers, self.subscribers = self.subscribers, []
+            self._emit_end(subscribers)
+        for subscriber in subscribers:
+            unregister_ai_generation(subscriber['message_id'])
+        return subscribers
+
+    def _emit_end(self, subscribers):
+        for subscriber in subscribers:
+            socketio.emit('ai_response_end', {'message_id': subscriber['message_id']}, room=subscriber['room'])
+            # 如果采集到推理内容，发送推理结束事件（用于一次性显示完整内容）
+            if self.supports_reasoning and self.reasoning:
+                socketio.emit('ai_reasoning_end', {
+                    'message_id': subscriber['message_id'],
+                    'content': self.reasoning
+                }, room=subscriber['room'])
+
+# 补齐房间内正在生成的AI回答（不会发起新的上游请求）
+def send_ai_catch_up(room, sid):
+    with ai_generations_lock:
+        streams = []
+        for generation in ai_generations.values():
+            stream = generation['stream']
+            if generation['room'] == room and stream is not None and stream not in streams:
+                streams.append(stream)
+    for stream in streams:
+        stream.catch_up(room, sid)
+
+def save_ai_message(subscriber, text):
+    try:
+        with room_lock(subscriber['room']):
+            if subscriber['room'] in room_history:
+                append_room_message(subscriber['room'], ChatMessage(
+                    MessageType.AI, subscriber['ai_name'], text,
+                    timestamp=subscriber['created_at'], message_id=subscriber['message_id']
+                ))
+    except Exception as e:
+        print(f"保存AI消息历史失败: {e}")
+
+# 结束一次生成：推送结束事件，为每个订阅者保存回答并更新统计
+def complete_ai_stream(stream, answer):
+    global ai_request_success
+    subscribers = stream.finish()
+    for subscriber in subscribers:
+        save_ai_message(subscriber, answer)
+    # 成功计数（每个订阅者都是一次请求）
+    with ai_stats_lock:
+        ai_request_success += len(subscribers)
+    notify_admin_update('stats')
+
+# 缓存命中或挂到正在生成的相同请求上，返回是否已处理
+def serve_ai_response_from_cache(key, subscriber, supports_reasoning):
+    with ai_response_cache_lock:
+        cached = _lookup_ai_response(key)
+        if cached is None:
+            stream = ai_response_streams.get(key)
+            if stream is not None and stream.subscribe(subscriber):
+                ai_response_cache_stats['coalesced'] += 1
+                return True
+            ai_response_cache_stats['misses'] += 1
+            return False
+        ai_response_cache_stats['hits'] += 1
+    # 回放缓存的回答
+    stream = AIResponseStream(supports_reasoning)
+    if not stream.subscribe(subscriber):
+        socketio.emit('ai_response_cancelled', {'message_id': subscriber['message_id']}, room=subscriber['room'])
+        unregister_ai_generation(subscriber['message_id'])
+        return True
+    answer, reasoning = cached
+    if reasoning:
+        stream.send_reasoning(reasoning)
+    if answer:
+        stream.send_answer(answer)
+    complete_ai_stream(stream, answer)
+    return True
+
+# 开始一次可共享的生成：登记为正在生成，供相同请求挂靠
+def publish_ai_response_stream(stream):
+    with ai_response_cache_lock:
+        ai_response_streams.setdefault(stream.key, stream)
+
+# 生成结束：不再接受挂靠，成功时写入缓存
+def release_ai_response_stream(stream, answer=None, reasoning=None):
+    with ai_response_cache_lock:
+        if ai_response_streams.get(stream.key) is stream:
+            del ai_response_streams[stream.key]
+        if stream.cache_ttl > 0 and answer:
+            ai_response_cache[stream.key] = (time.time() + stream.cache_ttl, answer, reasoning or '')
+            ai_response_cache.move_to_end(stream.key)
+            while len(ai_response_cache) > AI_RESPONSE_CACHE_SIZE:
+                ai_response_cache.popitem(last=False)
+
+# AI响应处理
+def handle_ai_response(room, username, user_message, custom_ai_name=None, message_id=None):
+    """处理AI响应并流式发送到房间，支持 Ollama 与第三方(OpenAI兼容)"""
+    global ai_request_total
+    message_id = message_id or new_ai_message_id(room)
+    cancelled = register_ai_generation(message_id, room, username)
+    stream = None
+    attached = False
+
+    try:
+        # 统计一次AI请求开始
+        with ai_stats_lock:
+            ai_request_total += 1
         notify_admin_update('stats')
-    except requests.exceptions.ConnectionError:
-        socketio.emit('ai_response_error', {
+        # 读取当前默认提供方
+        with ai_provider_lock:
+            provider = ai_provider
+        adapter = create_ai_adapter(provider)
+        subscriber = {
+            'room': room,
             'message_id': message_id,
-            'error': '无法连接到AI服务，请检查配置'
-        }, room=room)
-        notify_admin_update('stats')
+            'ai_name': custom_ai_name if custom_ai_name else adapter.ai_name,
+            'created_at': int(time.time())
+        }
+        messages, _ = build_ai_messages(room, adapter.config, user_message, adapter.model)
+        cache_settings = ai_response_cache_settings(adapter.config)
+        key = None
+        if cache_settings['response_cache']:
+            key = ai_response_cache_key(adapter, messages, user_message)
+            # 挂靠成功后由发起者的线程推送并在结束时注销本请求
+            attached = serve_ai_response_from_cache(key, subscriber, adapter.supports_reasoning)
+            if attached:
+                return
+
+        stream = AIResponseStream(adapter.supports_reasoning, cancelled, key, cache_settings['response_cache_ttl'])
+        if not stream.subscribe(subscriber):
+            socketio.emit('ai_response_cancelled', {'message_id': message_id}, room=room)
+            return
+        if key is not None:
+            publish_ai_response_stream(stream)
+        socketio.sleep(0.1)
+        stream_ai_response(stream, adapter, messages)
+
+    except requests.exceptions.Timeout:
+        _fail_ai_response(stream, room, message_id, 'AI响应超时，请检查后台服务是否正常')
+    except requests.exceptions.ConnectionError:
+        _fail_ai_response(stream, room, message_id, '无法连接到AI服务，请检查配置')
     except Exception as e:
         print(f"AI响应处理失败: {e}")
         import traceback
         traceback.print_exc()
-        socketio.emit('ai_response_error', {
-            'message_id': message_id,
-            'error': f'AI响应失败: {str(e)}'
-        }, room=room)
+        _fail_ai_response(stream, room, message_id, f'AI响应失败: {str(e)}')
+    finally:
+        if stream is not None and stream.key is not None:
+            release_ai_response_stream(stream)
+        if not attached:
+            unregister_ai_generation(message_id)
+
+def _fail_ai_response(stream, room, message_id, error):
+    if stream is not None:
+        stream.fail(error)
+    else:
+        socketio.emit('ai_response_error', {'message_id': message_id, 'error': error}, room=room)
+    notify_admin_update('stats')
+
+# AI回答推送合并策略：按房间在线人数分档 (人数上限, 最长合并间隔秒, 合并字节数)
+# 人数越多每个数据包的广播成本越高，合并得越多
+# 默认值，可在提供方配置的 stream_flush_tiers 中覆盖
+AI_CHUNK_FLUSH_TIERS = (
+    (5, 0.03, 64),
+    (20, 0.04, 256),
+    (None, 0.05, 1024)
+)
+ai_stream_stats = {'streams': 0, 'packets': 0, 'bytes': 0}  # 由 ai_stats_lock 保护
+
+def parse_stream_flush_tiers(value):
+    """stream_flush_tiers：[[人数上限或 null, 合并间隔秒, 合并字节数], ...]，人数上限递增，最后一档为 null"""
+    tiers = []
+    for max_users, interval, max_bytes in value or []:
+        tier = (None if max_users is None else int(max_users), float(interval), int(max_bytes))
+        if tier[1] <= 0 or tier[2] <= 0:
+            raise ValueError('合并间隔与合并字节数必须为正数')
+        if tiers and (tiers[-1][0] is None or (tier[0] is not None and tier[0] <= tiers[-1][0])):
+            raise ValueError('stream_flush_tiers 的人数上限必须递增，且只有最后一档为 null')
+        tiers.append(tier)
+    if tiers and tiers[-1][0] is not None:
+        raise ValueError('stream_flush_tiers 的最后一档人数上限必须为 null')
+    return [list(tier) for tier in tiers]
+
+def ai_chunk_flush_policy(audience, tiers=AI_CHUNK_FLUSH_TIERS):
+    """返回 (合并间隔秒, 合并字节数)"""
+    tiers = tiers or AI_CHUNK_FLUSH_TIERS
+    for max_users, interval, max_bytes in tiers:
+        if max_users is None or audience <= max_users:
+            return interval, max_bytes
+    return tuple(tiers[-1][1:])
+
+def record_ai_stream_started():
+    with ai_stats_lock:
+        ai_stream_stats['streams'] += 1
+
+def record_ai_chunk_emit(packets, size):
+    with ai_stats_lock:
+        ai_stream_stats['packets'] += packets
+        ai_stream_stats['bytes'] += packets * size
+
+def get_ai_stream_stats():
+    with ai_stats_lock:
+        stats = dict(ai_stream_stats)
+    stats['avg_packet_bytes'] = round(stats['bytes'] / stats['packets'], 1) if stats['packets'] else 0.0
+    stats['avg_packets_per_stream'] = round(stats['packets'] / stats['streams'], 1) if stats['streams'] else 0.0
+    return stats
+
+# 统一的AI流式管线
+def stream_ai_response(stream, adapter, messages):
+    """通过适配器发起请求，缓冲推送回答、分离推理内容，结束后为订阅者保存消息并更新统计
+
+    所有订阅者取消后立即停止读取并关闭上游连接。
+    """
+    cancelled = stream.cancelled
+    supports_reasoning = stream.supports_reasoning
+    started = time.time()
+    response, endpoint = post_ai_request(adapter, messages)
+    # 登记上游响应，全部取消时由取消方直接关闭连接
+    stream.attach_response(response)
+    endpoint_error = None
+
+    full_response = ''
+    full_reasoning = ''
+    think_parser = ThinkTagParser()
+    # 回答与推理按时间或字节数合并后推送（房间人数越多合并越多）
+    stream.start_flushing(*ai_chunk_flush_policy(stream.audience_size(), adapter.config.get('stream_flush_tiers')))
+    first_token = True
+    record_ai_stream_started()
+    try:
+        if response.status_code != 200 and not cancelled.is_set():
+            endpoint_error = f'HTTP {response.status_code}'
+            stream.fail(f'AI响应失败: HTTP {response.status_code}')
+            notify_admin_update('stats')
+            return
+
+        for line in response.iter_lines():
+            if cancelled.is_set():
+                break
+            if not line:
+                continue
+            try:
+                content, reasoning, done = adapter.decode_line(line)
+            except ValueError:
+                continue
+            if supports_reasoning:
+                # 未提供显式推理字段时，从文本内容中分离<think>…</think>（标签可能跨chunk）
+                if not reasoning and content:
+                    content, reasoning = think_parser.feed(content)
+            else:
+                reasoning = ''
+            if not content and not reasoning:
+                if done:
+                    break
+                continue
+            full_response += content
+            full_reasoning += reasoning
+            if first_token:
+                # 首字耗时按请求前模型是否仍驻留分为冷/热两类
+                first_token = False
+                record_ai_first_token(touch_ai_model(adapter, endpoint), time.time() - started)
+            # 超过间隔或积累足够字节时推送；上游暂停期间由定时推送按时间发出缓冲内容
+            if stream.buffer(content, reasoning):
+                # 让出执行权，使事件及时发送（不额外等待）
+                socketio.sleep(0)
+            if done:
+                break
+    except Exception as e:
+        # 取消时连接被另一线程关闭，读取会中断
+        if not cancelled.is_set():
+            endpoint_error = e
+            raise
+    finally:
+        stream.stop_flushing()
+        response.close()
+        release_ai_endpoint(adapter.name, endpoint, endpoint_error)
+
+    if cancelled.is_set():
+        # 各订阅者的部分回答已在取消时保存
+        notify_admin_update('stats')
+        return
+
+    # 输出解析器中残留的不完整标签前缀
+    tail, reasoning = think_parser.flush()
+    full_response += tail
+    full_reasoning += reasoning
+    stream.buffer(tail, reasoning)
+    stream.flush()
+    if stream.key is not None:
+        # 先停止挂靠并写入缓存，之后到达的相同请求直接命中缓存
+        release_ai_response_stream(stream, full_response, full_reasoning)
+    complete_ai_stream(stream, full_response)
+
+# AI生成取消：按 message_id 登记进行中的生成；取消时设置事件并立即关闭上游连接
+ai_generations = {}  # {message_id: {'room', 'username', 'cancelled': Event, 'stream': AIResponseStream}}
+ai_generations_lock = Lock()  # 叶子锁
+
+def register_ai_generation(message_id, room, username):
+    """登记生成并返回其取消事件；已登记时返回原有事件"""
+    with ai_generations_lock:
+        generation = ai_generations.get(message_id)
+        if generation is not None:
+            return generation['cancelled']
+        cancelled = create_event()
+        ai_generations[message_id] = {
+            'room': room,
+            'username': username,
+            'cancelled': cancelled,
+            'stream': None
+        }
+    return cancelled
+
+def unregister_ai_generation(message_id):
+    with ai_generations_lock:
+        ai_generations.pop(message_id, None)
+
+# 取消一个AI请求（排队中或生成中），返回是否找到该请求
+def cancel_ai_generation(message_id):
+    global ai_queued_total
+    job = None
+    with ai_scheduler_lock:
+        for room, room_queue in list(ai_room_queues.items()):
+            for queued in room_queue:
+                if queued['message_id'] == message_id:
+                    job = queued
+                    break
+            if job is not None:
+                room_queue.remove(job)
+                ai_queued_total -= 1
+                if not room_queue:
+                    del ai_room_queues[room]
+                break
+    if job is not None:
+        # 排队中的请求直接移出队列
+        socketio.emit('ai_response_cancelled', {'message_id': message_id}, room=job['room'])
         notify_admin_update('stats')
+        return True
+    
+    with ai_generations_lock:
+        generation = ai_generations.get(message_id)
+        if generation is None:
+            return False
+        stream = generation['stream']
+        if stream is None:
+            # 尚未开始推送，发起者订阅时会发现已取消
+            generation['cancelled'].set()
+    if stream is not None:
+        # 只移除该请求；同一流上还有其他订阅者时上游继续生成
+        stream.cancel(message_id)
+    return True
+
+def _find_ai_requests(room, username=None):
+    """房间内（可限定请求者）所有排队中与生成中的请求ID"""
+    with ai_scheduler_lock:
+        message_ids = [
+            job['message_id'] for job in ai_room_queues.get(room, ())
+            if username is None or job['username'] == username
+        ]
+    with ai_generations_lock:
+        message_ids.extend(
+            message_id for message_id, generation in ai_generations.items()
+            if generation['room'] == room and (username is None or generation['username'] == username)
+        )
+    return message_ids
+
+# 取消房间内的所有AI请求（房间解散或无人时）
+def cancel_room_ai(room):
+    for message_id in _find_ai_requests(room):
+        cancel_ai_generation(message_id)
+
+# AI请求调度：全局并发上限 + 每个房间一个FIFO队列，房间之间轮转，避免一个繁忙房间占满后端
+AI_MAX_IN_FLIGHT = 2
+# 单个房间最多排队的请求数
+AI_ROOM_QUEUE_DEPTH = 5
+# 全部房间排队总数上限，超出时直接拒绝
+AI_MAX_QUEUED_TOTAL = 50
+# 后台任务（如滚动摘要）同时占用的名额上限；后台任务只在没有用户请求排队时启动
+AI_MAX_BACKGROUND_IN_FLIGHT = 1
+ai_scheduler_lock = Lock()  # 保护以下调度状态；持有期间只会再获取 ai_generations_lock
+ai_in_flight = 0  # 含后台任务
+ai_room_queues = OrderedDict()  # {room: deque(job)}，键顺序即轮转顺序
+ai_queued_total = 0
+ai_background_queue = deque()  # 低优先级后台任务 [{'key', 'fn', 'args'}]
+ai_background_keys = set()  # 排队中或运行中的后台任务键，同一任务不重复提交
+ai_background_in_flight = 0
+ai_request_ids = itertools.count(1)  # 进程内递增序号，同一毫秒内的请求ID也不会重复
+
+def new_ai_message_id(room):
+    """AI请求ID：调度队列、取消登记表与取代逻辑都以它为键，必须唯一"""
+    return f"{room}_AI_{int(time.time() * 1000)}_{next(ai_request_ids)}"
+
+ai_scheduler_stats = {
+    'started': 0,
+    'rejected': 0,
+    'recent_waits': deque(maxlen=100)  # 最近请求的排队时间（秒）
+}
+
+# 提交AI请求
+def submit_ai_request(room, username, user_message, custom_ai_name=None):
+    """有空闲名额且无人排队时立即开始，否则进入房间队列；过载时拒绝
+
+    返回 (是否接受, 房间内排队位置（0 表示已开始）或错误信息)
+    """
+    global ai_in_flight, ai_queued_total
+    # 同一用户在同一房间的新请求取代其尚未完成的旧请求
+    for message_id in _find_ai_requests(room, username):
+        cancel_ai_generation(message_id)
+    job = {
+        'room': room,
+        'username': username,
+        'message': user_message,
+        'custom_ai_name': custom_ai_name,
+        'message_id': new_ai_message_id(room),
+        'enqueued_at': time.time()
+    }
+    with ai_scheduler_lock:
+        if ai_in_flight < AI_MAX_IN_FLIGHT and not ai_room_queues:
+            ai_in_flight += 1
+            # 与占用名额在同一临界区内登记，取消请求总能在队列或登记表中找到它
+            register_ai_generation(job['message_id'], room, username)
+            start_job = True
+        else:
+            start_job = False
+            room_queue = ai_room_queues.get(room)
+            if room_queue is not None and len(room_queue) >= AI_ROOM_QUEUE_DEPTH:
+                ai_scheduler_stats['rejected'] += 1
+                return False, '当前房间的AI请求过多，请稍后再试'
+            if ai_queued_total >= AI_MAX_QUEUED_TOTAL:
+                ai_scheduler_stats['rejected'] += 1
+                return False, 'AI服务繁忙，请稍后再试'
+            room_queue = ai_room_queues.setdefault(room, deque())
+            room_queue.append(job)
+            ai_queued_total += 1
+            position = len(room_queue)
+    if start_job:
+        _start_ai_job(job)
+        return True, 0
+    socketio.emit('ai_queue_position', {
+        'message_id': job['message_id'],
+        'username': username,
+        'position': position
+    }, room=room)
+    notify_admin_update('stats')
+    return True, position
+
+def _start_ai_job(job):
+    # 调用者已在出队的临界区内登记该请求
+    wait = time.time() - job['enqueued_at']
+    with ai_scheduler_lock:
+        ai_scheduler_stats['started'] += 1
+        ai_scheduler_stats['recent_waits'].append(wait)
+    socketio.start_background_task(_run_ai_job, job)
+
+def _run_ai_job(job):
+    try:
+        handle_ai_response(job['room'], job['username'], job['message'], job['custom_ai_name'], job['message_id'])
+    finally:
+        _finish_ai_job()
+
+# 提交低优先级后台任务，与用户请求共享并发名额
+def submit_ai_background(key, fn, *args):
+    """返回是否已提交（同一任务已在排队或运行时不重复提交）"""
+    with ai_scheduler_lock:
+        if key in ai_background_keys:
+            return False
+        ai_background_keys.add(key)
+        ai_background_queue.append({'key': key, 'fn': fn, 'args': args})
+        jobs = _take_background_jobs()
+    for job in jobs:
+        socketio.start_background_task(_run_ai_background_job, job)
+    return True
+
+def _take_background_jobs():
+    """取出可以启动的后台任务并占用名额（调用者持有 ai_scheduler_lock）"""
+    global ai_in_flight, ai_background_in_flight
+    jobs = []
+    while (ai_background_queue and not ai_room_queues and ai_in_flight < AI_MAX_IN_FLIGHT
+           and ai_background_in_flight < AI_MAX_BACKGROUND_IN_FLIGHT):
+        jobs.append(ai_background_queue.popleft())
+        ai_in_flight += 1
+        ai_background_in_flight += 1
+    return jobs
+
+def _run_ai_background_job(job):
+    try:
+        job['fn'](*job['args'])
+    except Exception as e:
+        print(f"后台AI任务失败: {e}")
+    finally:
+        with ai_scheduler_lock:
+            ai_background_keys.discard(job['key'])
+        _finish_ai_job(background=True)
+
+# 释放名额并按房间轮转启动排队中的请求，用户请求都已开始后再启动后台任务
+def _finish_ai_job(background=False):
+    global ai_in_flight, ai_queued_total, ai_background_in_flight
+    started = []
+    with ai_scheduler_lock:
+        ai_in_flight -= 1
+        if background:
+            ai_background_in_flight -= 1
+        while ai_in_flight < AI_MAX_IN_FLIGHT and ai_room_queues:
+            room, room_queue = next(iter(ai_room_queues.items()))
+            job = room_queue.popleft()
+            ai_queued_total -= 1
+            # 出队即登记（同一临界区），从出队到开始生成之间也能被取消
+            register_ai_generation(job['message_id'], job['room'], job['username'])
+            # 该房间移到轮转末尾，没有剩余请求时移出
+            del ai_room_queues[room]
+            if room_queue:
+                ai_room_queues[room] = room_queue
+            ai_in_flight += 1
+            started.append((job, list(room_queue)))
+        background_jobs = _take_background_jobs()
+    for job in background_jobs:
+        socketio.start_background_task(_run_ai_background_job, job)
+    for job, remaining in started:
+        _start_ai_job(job)
+        # 通知该房间其余请求新的排队位置
+        for position, waiting in enumerate(remaining, 1):
+            socketio.emit('ai_queue_position', {
+                'message_id': waiting['message_id'],
+                'username': waiting['username'],
+                'position': position
+            }, room=waiting['room'])
+
+def get_ai_scheduler_stats():
+    with ai_scheduler_lock:
+        waits = list(ai_scheduler_stats['recent_waits'])
+        stats = {
+            'in_flight': ai_in_flight,
+            'max_in_flight': AI_MAX_IN_FLIGHT,
+            'queued': ai_queued_total,
+            'queued_rooms': len(ai_room_queues),
+            'started': ai_scheduler_stats['started'],
+            'rejected': ai_scheduler_stats['rejected'],
+            'background_running': ai_background_in_flight,
+            'background_queued': len(ai_background_queue)
+        }
+    stats['avg_wait_ms'] = round(sum(waits) / len(waits) * 1000, 1) if waits else 0.0
+    stats['max_wait_ms'] = round(max(waits) * 1000, 1) if waits else 0.0
+    return stats
+
+# 房间对话滚动摘要：后台线程在AI空闲时把滑出上下文窗口的旧消息并入房间摘要
+# 摘要随房间历史保存，构建上下文时放在最近窗口之前，提示保持短小的同时保留更早的信息
+AI_SUMMARY_DEFAULTS = {
+    'context_summary': True  # 是否为使用过AI的房间生成滚动摘要（可在提供方配置中关闭）
+}
+
+# 可在提供方配置中调整的参数（配置 API 按默认值的类型转换）
+AI_TUNABLE_DEFAULTS = dict(
+    HTTP_POOL_DEFAULTS, **AI_RESPONSE_CACHE_DEFAULTS, **AI_CONTEXT_BUDGET_DEFAULTS, **AI_SUMMARY_DEFAULTS,
+    **AI_RETRIEVAL_DEFAULTS
+)
+
+# 检查间隔（秒）
+AI_SUMMARY_INTERVAL = 60
+# 滑出窗口的消息达到该条数才更新摘要
+AI_SUMMARY_MIN_MESSAGES = 10
+# 单次最多并入的消息条数
+AI_SUMMARY_MAX_MESSAGES = 100
+# 摘要长度上限（字符）
+AI_SUMMARY_MAX_CHARS = 800
+AI_SUMMARY_PROMPT = (
+    "你是聊天记录摘要助手。请把“已有摘要”与“新的聊天记录”合并为一段新的摘要，"
+    f"不超过{AI_SUMMARY_MAX_CHARS}字。保留参与者昵称、提到的事实、做出的决定和未解决的问题，"
+    "省略寒暄与重复内容。只输出摘要正文。"
+)
+summary_status = {'runs': 0, 'failed': 0, 'last_run': None, 'last_ms': 0.0}  # 由 ai_stats_lock 保护
+
+def room_needs_summary(room):
+    with room_lock(room):
+        room_data = room_history.get(room)
+        return room_data is not None and len(_pending_summary_messages(room_data)) >= AI_SUMMARY_MIN_MESSAGES
+
+def _pending_summary_messages(room_data):
+    """已滑出上下文窗口、尚未并入摘要的用户/AI消息（调用者持有该房间的分段锁）"""
+    messages = room_data['messages']
+    ai_context = room_data['ai_context']
+    # 窗口未满时没有消息滑出；从未使用过AI的房间不需要摘要
+    if len(ai_context) < ai_context.maxlen:
+        return []
+    if room_data['summary'] is None and not any(m.type == MessageType.AI for m in ai_context):
+        return []
+    first_seq = messages[0].seq
+    start = first_seq
+    if room_data['summary'] is not None:
+        start = max(start, room_data['summary']['through_seq'] + 1)
+    end = ai_context[0].seq
+    if end <= start:
+        return []
+    return [m for m in islice(messages, start - first_seq, end - first_seq) if m.type in AI_CONTEXT_TYPES]
+
+# 当前提供方的适配器；提供方关闭了滚动摘要时返回 None
+def ai_summary_adapter():
+    with ai_provider_lock:
+        provider = ai_provider
+    adapter = create_ai_adapter(provider)
+    if not config_settings(adapter.config, AI_SUMMARY_DEFAULTS)['context_summary']:
+        return None
+    return adapter
+
+# 一次性请求AI并返回完整回答（不推送到房间）
+def complete_ai_request(adapter, messages):
+    response, endpoint = post_ai_request(adapter, messages)
+    touch_ai_model(adapter, endpoint)
+    think_parser = ThinkTagParser()
+    parts = []
+    endpoint_error = None
+    try:
+        if response.status_code != 200:
+            raise RuntimeError(f'HTTP {response.status_code}')
+        for line in response.iter_lines():
+            if not line:
+                continue
+            try:
+                content, _, done = adapter.decode_line(line)
+            except ValueError:
+                continue
+            if content:
+                parts.append(think_parser.feed(content)[0])
+            if done:
+                break
+    except Exception as e:
+        endpoint_error = e
+        raise
+    finally:
+        response.close()
+        release_ai_endpoint(adapter.name, endpoint, endpoint_error)
+    parts.append(think_parser.flush()[0])
+    return ''.join(parts).strip()
+
+# 更新单个房间的摘要，返回是否更新
+def summarize_room(room):
+    with room_lock(room):
+        room_data = room_history.get(room)
+        if room_data is None:
+            return False
+        pending = _pending_summary_messages(room_data)[:AI_SUMMARY_MAX_MESSAGES]
+        previous = room_data['summary']
+    if len(pending) < AI_SUMMARY_MIN_MESSAGES:
+        return False
+    # 提交后提供方或配置可能已变化，执行前再检查一次
+    adapter = ai_summary_adapter()
+    if adapter is None:
+        return False
+
+    # 新消息按时间正序装入提示预算
+    budget = ai_context_budget(adapter.config, adapter.model)
+    header = f"已有摘要：\n{previous['text'] if previous else '（无）'}\n\n新的聊天记录：\n"
+    used = estimate_tokens(AI_SUMMARY_PROMPT) + estimate_tokens(header) + 2 * AI_MESSAGE_TOKEN_OVERHEAD
+    lines = []
+    through_seq = None
+    for message in pending:
+        text = truncate_to_tokens(message.text, budget['context_message_tokens'])
+        line = f"【{AI_SUMMARY_ASSISTANT_LABEL if message.type == MessageType.AI else message.username}】{text}"
+        tokens = estimate_tokens(line) + 1
+        if lines and used + tokens > budget['prompt_tokens']:
+            break
+        used += tokens
+        lines.append(line)
+        through_seq = message.seq
+
+    started = time.time()
+    try:
+        text = complete_ai_request(adapter, [
+            {'role': 'system', 'content': AI_SUMMARY_PROMPT},
+            {'role': 'user', 'content': header + '\n'.join(lines)}
+        ])
+    except Exception as e:
+        with ai_stats_lock:
+            summary_status['failed'] += 1
+        print(f"生成房间摘要失败 {room}: {e}")
+        return False
+    finally:
+        with ai_stats_lock:
+            summary_status['runs'] += 1
+            summary_status['last_run'] = datetime.now()
+            summary_status['last_ms'] = (time.time() - started) * 1000
+    if not text:
+        return False
+
+    summary = {
+        'text': text[:AI_SUMMARY_MAX_CHARS],
+        'through_seq': through_seq,
+        'updated_at': int(time.time())
+    }
+    with room_lock(room):
+        room_data = room_history.get(room)
+        # 期间房间被删除或摘要已被更新时放弃本次结果
+        if room_data is None or room_data['summary'] is not previous:
+            return False
+        room_data['summary'] = summary
+        append_room_log(room, {'op': 'summary', 'summary': summary})
+    return True
+
+# 后台摘要线程
+def summary_worker():
+    while True:
+        socketio.sleep(AI_SUMMARY_INTERVAL)
+        try:
+            if not ollama_config.get('enabled'):
+                continue
+            # 摘要已关闭时不占用调度器名额，也不请求后端
+            if ai_summary_adapter() is None:
+                continue
+            with room_registry_lock:
+                rooms = list(room_history)
+            # 作为低优先级任务交给AI调度器，占用并发名额且让排队中的用户请求先执行
+            for room in rooms:
+                if room_needs_summary(room):
+                    submit_ai_background(('summary', room), summarize_room, room)
+        except Exception as e:
+            print(f"后台摘要失败: {e}")
+
+def get_summary_status():
+    with room_registry_lock:
+        rooms = sum(1 for room_data in room_history.values() if room_data['summary'] is not None)
+    with ai_stats_lock:
+        status = dict(summary_status)
+    last_run = status['last_run']
+    return {
+        'rooms': rooms,
+        'runs': status['runs'],
+        'failed': status['failed'],
+        'last_run': last_run.strftime('%Y-%m-%d %H:%M:%S') if last_run else None,
+        'last_ms': round(status['last_ms'], 1)
+    }
+
+# 链接预览缓存：按规范化URL缓存结果（LRU + TTL），失败结果也短暂缓存，同一URL的并发请求只抓取一次
+LINK_PREVIEW_CACHE_SIZE = 1000
+# 成功结果的缓存时间（秒）
+LINK_PREVIEW_CACHE_TTL = 3600
+# 失败/超时/无标题结果的缓存时间（秒）
+LINK_PREVIEW_NEGATIVE_TTL = 300
+# 等待其他线程抓取同一URL的最长时间（秒）
+LINK_PREVIEW_WAIT_TIMEOUT = 10
+link_preview_cache = OrderedDict()  # {normalized_url: (expires_at, preview or None)}
+link_preview_inflight = {}  # {normalized_url: Event} 正在抓取的URL
+link_preview_cache_lock = Lock()  # 叶子锁，持有期间不进行网络请求
+link_preview_stats = {'hits': 0, 'negative_hits': 0, 'misses': 0, 'coalesced': 0}
+
+def normalize_preview_url(url):
+    """规范化URL作为缓存键：协议与主机小写，去掉默认端口与片段"""
+    try:
+        parts = urlsplit(url.strip())
+        scheme = parts.scheme.lower()
+        host = (parts.hostname or '').lower()
+        port = parts.port
+    except ValueError:
+        return url
+    if port is not None and (scheme, port) not in (('http', 80), ('https', 443)):
+        host = f'{host}:{port}'
+    return urlunsplit((scheme, host, parts.path or '/', parts.query, ''))
+
+def _lookup_link_preview(key):
+    """读取未过期的缓存项，返回 (是否命中, 预览)（调用者持有 link_preview_cache_lock）"""
+    entry = link_preview_cache.get(key)
+    if entry is None:
+        return False, None
+    expires_at, preview = entry
+    if expires_at <= time.time():
+        del link_preview_cache[key]
+        return False, None
+    link_preview_cache.move_to_end(key)
+    return True, preview
+
+def _with_preview_url(preview, url):
+    # 缓存的预览可能来自另一种写法的同一URL，返回时使用本次消息中的原始链接
+    if preview is None:
+        return None
+    return dict(preview, url=url)
+
+# 获取链接预览（带缓存）
+def get_cached_link_preview(url):
+    key = normalize_preview_url(url)
+    with link_preview_cache_lock:
+        hit, preview = _lookup_link_preview(key)
+        if hit:
+            link_preview_stats['hits' if preview is not None else 'negative_hits'] += 1
+            return _with_preview_url(preview, url)
+        event = link_preview_inflight.get(key)
+        owner = event is None
+        if owner:
+            event = create_event()
+            link_preview_inflight[key] = event
+            link_preview_stats['misses'] += 1
+        else:
+            link_preview_stats['coalesced'] += 1
+    
+    if not owner:
+        # 其他线程正在抓取同一URL，等待其结果
+        event.wait(LINK_PREVIEW_WAIT_TIMEOUT)
+        with link_preview_cache_lock:
+            _, preview = _lookup_link_preview(key)
+        return _with_preview_url(preview, url)
+    
+    preview = None
+    try:
+        preview = get_link_preview(url)
+    finally:
+        ttl = LINK_PREVIEW_CACHE_TTL if preview is not None else LINK_PREVIEW_NEGATIVE_TTL
+        with link_preview_cache_lock:
+            link_preview_cache[key] = (time.time() + ttl, preview)
+            link_preview_cache.move_to_end(key)
+            while len(link_preview_cache) > LINK_PREVIEW_CACHE_SIZE:
+                link_preview_cache.popitem(last=False)
+            link_preview_inflight.pop(key, None)
+        event.set()
+    return preview
+
+def get_link_preview_cache_stats():
+    with link_preview_cache_lock:
+        stats = dict(link_preview_stats)
+        stats['size'] = len(link_preview_cache)
+        stats['inflight'] = len(link_preview_inflight)
+    lookups = stats['hits'] + stats['negative_hits'] + stats['misses'] + stats['coalesced']
+    served = lookups - stats['misses']
+    stats['hit_rate'] = f"{(served / lookups * 100.0) if lookups else 0.0:.1f}%"
+    return stats
+
+# 链接预览抓取：流式读取，只解析 <head>，读到 </head>/<body> 或达到字节上限即停止
+LINK_PREVIEW_MAX_BYTES = 256 * 1024
+# 单个链接的总抓取时间上限（秒）
+LINK_PREVIEW_TIMEOUT = 5
+LINK_PREVIEW_USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+LINK_PREVIEW_META_CHARSET_RE = re.compile(rb'<meta[^>]+charset=["\']?([\w-]+)', re.IGNORECASE)
+
+class HeadMetaParser(HTMLParser):
+    """只提取 <head> 中的 <title> 与 <meta> 标签"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.metas = {}  # {property/name（小写）: content}，同名时保留第一个
+        self.title = None
+        self.done = False
+        self._title_parts = None
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        if tag == 'meta':
+            attrs = dict(attrs)
+            key = attrs.get('property') or attrs.get('name')
+            content = attrs.get('content')
+            if key and content:
+                self.metas.setdefault(key.lower(), content)
+        elif tag == 'title' and self.title is None:
+            self._title_parts = []
+        elif tag == 'body':
+            self.done = True
+
+    def handle_data(self, data):
+        if self._title_parts is not None:
+            self._title_parts.append(data)
+
+    def handle_endtag(self, tag):
+        if tag == 'title' and self._title_parts is not None:
+            self.title = ''.join(self._title_parts).strip() or None
+            self._title_parts = None
+        elif tag == 'head':
+            self.done = True
+
+def _preview_decoder(response, first_chunk):
+    """按响应头或 <meta charset> 确定编码，默认 UTF-8"""
+    match = re.search(r'charset=["\']?([\w-]+)', response.headers.get('Content-Type', ''), re.IGNORECASE)
+    encoding = match.group(1) if match else None
+    if not encoding:
+        match = LINK_PREVIEW_META_CHARSET_RE.search(first_chunk)
+        encoding = match.group(1).decode('ascii') if match else 'utf-8'
+    try:
+        return codecs.getincrementaldecoder(encoding)(errors='replace')
+    except LookupError:
+        return codecs.getincrementaldecoder('utf-8')(errors='replace')
 
 def get_link_preview(url):
     """获取链接的标题和描述"""
     try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
-        
-        # 设置较短的超时时间
-        response = requests.get(url, headers=headers, timeout=3)
-        response.encoding = response.apparent_encoding
-        
-        soup = BeautifulSoup(response.text, 'html.parser')
-        
-        # 获取标题
-        title = None
-        
-        # 优先获取 og:title
-        og_title = soup.find('meta', property='og:title')
-        if og_title and og_title.get('content'):
-            title = og_title.get('content')
-        
-        # 其次获取 twitter:title
-        if not title:
-            twitter_title = soup.find('meta', attrs={'name': 'twitter:title'})
-            if twitter_title and twitter_title.get('content'):
-                title = twitter_title.get('content')
+        headers = {'User-Agent': LINK_PREVIEW_USER_AGENT}
+        started = time.time()
         
-        # 最后获取 title 标签
-        if not title:
-            title_tag = soup.find('title')
-            if title_tag and title_tag.string:
-                title = str(title_tag.string)
-        
-        # 获取描述
-        description = None
-        og_desc = soup.find('meta', property='og:description')
-        if og_desc and og_desc.get('content'):
-            description = og_desc.get('content')
-        
-        if not description:
-            meta_desc = soup.find('meta', attrs={'name': 'description'})
-            if meta_desc and meta_desc.get('content'):
-                description = meta_desc.get('content')
-        
-        # 获取网站名称
-        site_name = None
-        og_site = soup.find('meta', property='og:site_name')
-        if og_site and og_site.get('content'):
-            site_name = og_site.get('content')
+        # 设置较短的超时时间，流式读取
+        http_session = get_http_session('preview', LINK_PREVIEW_HTTP_SETTINGS)
+        response = http_session.get(url, headers=headers, timeout=http_timeout(LINK_PREVIEW_HTTP_SETTINGS), stream=True)
+        try:
+            content_type = response.headers.get('Content-Type', '')
+            if content_type and 'html' not in content_type.lower():
+                return None
+            parser = HeadMetaParser()
+            decoder = None
+            received = 0
+            for chunk in response.iter_content(chunk_size=8192):
+                if not chunk:
+                    continue
+                if decoder is None:
+                    decoder = _preview_decoder(response, chunk)
+                received += len(chunk)
+                parser.feed(decoder.decode(chunk))
+                if parser.done or received >= LINK_PREVIEW_MAX_BYTES or time.time() - started > LINK_PREVIEW_TIMEOUT:
+                    break
+        finally:
+            response.close()
         
-        if not site_name:
-            site_name = urlparse(url).netloc
+        metas = parser.metas
+        # 标题：优先 og:title，其次 twitter:title，最后 title 标签
+        title = metas.get('og:title') or metas.get('twitter:title') or parser.title
+        # 描述：优先 og:description，其次 description
+        description = metas.get('og:description') or metas.get('description')
+        # 网站名称
+        site_name = metas.get('og:site_name') or urlparse(url).netloc
         
         if title:
-            # 确保 title 和 description 是字符串类型
-            title_str = str(title).strip() if title else None
+            title_str = title.strip()
             description_str = None
             if description:
-                desc = str(description).strip()
+                desc = description.strip()
                 description_str = desc[:100] + '...' if len(desc) > 100 else desc
             
             return {
                 'url': url,
                 'title': title_str,
                 'description': description_str,
-                'site_name': str(site_name) if site_name else None
+                'site_name': site_name or None
             }
     except Exception as e:
         print(f"获取链接预览失败 {url}: {e}")
     
     return None
 
+# 链接预览工作线程池：任务放入有界队列，由固定数量的工作线程处理
+LINK_PREVIEW_WORKERS = 4
+LINK_PREVIEW_QUEUE_SIZE = 200
+# 单条消息最多预览的链接数
+LINK_PREVIEW_MAX_URLS = 5
+# 同一主机同时抓取的链接数上限，超出的任务在该主机的等待队列中排队
+LINK_PREVIEW_PER_HOST = 2
+LINK_PREVIEW_HOST_BACKLOG = 20
+link_preview_queue = create_queue(maxsize=LINK_PREVIEW_QUEUE_SIZE)
+preview_pool_lock = Lock()  # 叶子锁，保护以下状态
+preview_host_active = {}  # {host: 正在抓取的任务数}
+preview_host_waiting = {}  # {host: deque(job)}
+preview_pool_stats = {'submitted': 0, 'dropped': 0, 'completed': 0}
+
+def _preview_host(url):
+    try:
+        return (urlsplit(url).hostname or '').lower()
+    except ValueError:
+        return ''
+
+# 提交链接预览任务
+def submit_link_preview(url, message_id, room, index=0):
+    """队列已满时丢弃最旧的任务（越新的消息越值得预览）"""
+    job = (url, message_id, room, index)
+    dropped = 0
+    while True:
+        try:
+            link_preview_queue.put_nowait(job)
+            break
+        except queue.Full:
+            try:
+                link_preview_queue.get_nowait()
+                dropped += 1
+            except queue.Empty:
+                pass
+    with preview_pool_lock:
+        preview_pool_stats['submitted'] += 1
+        preview_pool_stats['dropped'] += dropped
+
+def _acquire_preview_host(host, job):
+    """占用主机的抓取名额；名额已满时任务进入该主机的等待队列并返回 False"""
+    with preview_pool_lock:
+        active = preview_host_active.get(host, 0)
+        if active < LINK_PREVIEW_PER_HOST:
+            preview_host_active[host] = active + 1
+            return True
+        waiting = preview_host_waiting.setdefault(host, deque())
+        if len(waiting) >= LINK_PREVIEW_HOST_BACKLOG:
+            waiting.popleft()
+            preview_pool_stats['dropped'] += 1
+        waiting.append(job)
+        return False
+
+def _release_preview_host(host):
+    """释放名额；该主机有等待任务时把名额直接交给下一个任务并返回它"""
+    with preview_pool_lock:
+        preview_pool_stats['completed'] += 1
+        waiting = preview_host_waiting.get(host)
+        if waiting:
+            job = waiting.popleft()
+            if not waiting:
+                del preview_host_waiting[host]
+            return job
+        preview_host_active[host] -= 1
+        if preview_host_active[host] <= 0:
+            del preview_host_active[host]
+        return None
+
+# 链接预览工作线程
+def preview_worker():
+    while True:
+        job = link_preview_queue.get()
+        host = _preview_host(job[0])
+        if not _acquire_preview_host(host, job):
+            continue
+        while job is not None:
+            fetch_and_send_preview(*job)
+            job = _release_preview_host(host)
+
+def get_link_preview_pool_stats():
+    with preview_pool_lock:
+        stats = dict(preview_pool_stats)
+        stats['active'] = sum(preview_host_active.values())
+        stats['waiting'] = sum(len(waiting) for waiting in preview_host_waiting.values())
+    stats['queued'] = link_preview_queue.qsize()
+    return stats
+
 # 文件上传路由
 @app.route('/upload', methods=['POST'])
 def upload_file():
@@ -1807,89 +4447,76 @@ def upload_file():
         if file:
             filename = secure_filename(file.filename)
             
-            # 计算文件哈希值
-            file_hash = calculate_file_hash(file.stream)
+            # 一次读取：边计算哈希边写入临时文件（不持有任何锁）
+            temp_path, file_hash, file_size = save_upload_stream(file.stream)
             
             # 检查是否已存在相同哈希的文件
             unique_filename = None
             is_duplicate = False
             
-            with file_hash_lock:
-                if file_hash in file_hash_map:
-                    # 检查文件是否真实存在
-                    cached_filename = file_hash_map[file_hash]
-                    cached_filepath = os.path.join(app.config['UPLOAD_FOLDER'], cached_filename)
-                    
-                    if os.path.exists(cached_filepath):
-                        # 文件存在，使用已有文件
-                        unique_filename = cached_filename
-                        is_duplicate = True
-                        print(f"检测到重复文件: {filename}, 使用已有文件: {unique_filename}")
-                    else:
-                        # 文件已被删除，需要重新上传
-                        print(f"缓存文件已丢失: {cached_filename}, 重新上传: {filename}")
-                        # 删除失效的哈希映射
-                        del file_hash_map[file_hash]
-                        save_hash_map()
-                
-                # 如果文件不存在或哈希映射中没有，保存新文件
-                if not is_duplicate:
-                    timestamp = int(time.time() * 1000)
-                    unique_filename = f"{timestamp}_{filename}"
-                    filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-                    
-                    # 保存文件
-                    file.save(filepath)
+            try:
+                # 只有相同哈希的上传在这里互相等待
+                with file_hash_guard(file_hash):
+                    with file_hash_lock:
+                        cached_filename = file_hash_map.get(file_hash)
+                        if cached_filename is not None:
+                            # 检查文件是否真实存在
+                            cached_filepath = os.path.join(app.config['UPLOAD_FOLDER'], cached_filename)
+                            if os.path.exists(cached_filepath):
+                                # 文件存在，使用已有文件
+                                unique_filename = cached_filename
+                                is_duplicate = True
+                                print(f"检测到重复文件: {filename}, 使用已有文件: {unique_filename}")
+                            else:
+                                # 文件已被删除，需要重新上传
+                                print(f"缓存文件已丢失: {cached_filename}, 重新上传: {filename}")
+                                # 删除失效的哈希映射
+                                remove_file_hash(cached_filename)
+                                save_hash_map()
                     
-                    # 记录哈希映射
-                    file_hash_map[file_hash] = unique_filename
-                    save_hash_map()
-                    print(f"上传新文件: {filename}, 保存为: {unique_filename}")
+                    # 如果文件不存在或哈希映射中没有，把临时文件原子地移动到位
+                    if not is_duplicate:
+                        unique_filename = publish_upload(temp_path, filename)
+                        temp_path = None
+                        
+                        # 记录哈希映射
+                        with file_hash_lock:
+                            set_file_hash(file_hash, unique_filename)
+                            save_hash_map()
+                        print(f"上传新文件: {filename}, 保存为: {unique_filename}")
+            finally:
+                # 重复文件（或出错时）丢弃临时文件
+                if temp_path is not None:
+                    os.remove(temp_path)
             
-            # 获取文件大小和类型
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-            file_size = os.path.getsize(filepath)
+            # 记录文件大小，获取文件类型
+            record_file_size(unique_filename, file_size)
             file_size_str = format_file_size(file_size)
             file_type = get_file_type(filename)  # 获取文件类型
             
             # 发送文件消息到房间
-            file_message = {
-                'username': username,
-                'message': f'发送了文件: {filename}' + (' (已缓存)' if is_duplicate else ''),
-                'type': 'file',
-                'file_info': {
-                    'filename': filename,
-                    'original_filename': filename,  # 添加原始文件名
-                    'unique_filename': unique_filename,
-                    'size': file_size_str,
-                    'download_url': f'/download/{unique_filename}',
-                    'file_type': file_type,  # 添加文件类型
-                    'is_cached': is_duplicate
-                },
-                'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                'message_id': f"{room}_{username}_{int(time.time() * 1000)}"
-            }
-            
-            # 通过Socket.IO发送文件消息到房间的所有用户
-            with app.app_context():
-                socketio.emit('message', file_message, room=room, namespace='/')
+            file_message = ChatMessage(
+                MessageType.FILE, username,
+                f'发送了文件: {filename}' + (' (已缓存)' if is_duplicate else ''),
+                message_id=f"{room}_{username}_{int(time.time() * 1000)}",
+                file_info=FileInfo(filename, unique_filename, file_size_str, file_type, is_duplicate)
+            )
             
-            # 保存到历史记录
+            # 先保存到历史记录以分配序号
             try:
-                with history_lock:
+                with room_lock(room):
                     if room in room_history:
-                        room_history[room]['messages'].append(file_message)
-                        room_history[room]['last_active'] = datetime.now()
                         # 将文件关联到房间
-                        if 'files' not in room_history[room]:
-                            room_history[room]['files'] = set()
-                        room_history[room]['files'].add(unique_filename)
+                        add_room_file(room, unique_filename)
+                        append_room_message(room, file_message)
                         print(f"文件 {unique_filename} 已关联到房间 {room}")
-                        if len(room_history[room]['messages']) % 10 == 0:
-                            save_history()
             except Exception as e:
                 print(f"保存文件消息历史失败: {e}")
             
+            # 通过Socket.IO发送文件消息到房间的所有用户
+            with app.app_context():
+                socketio.emit('message', file_message.to_dict(), room=room, namespace='/')
+            
             # 通知管理员界面更新文件列表和统计数据
             notify_admin_update('files')
             notify_admin_update('stats')
@@ -1922,5 +4549,43 @@ def format_file_size(size):
         size /= 1024.0
     return f"{size:.2f} TB"
 
+background_workers_started = False
+background_workers_lock = Lock()
+
+# 启动后台线程（持久化、链接预览、AI摘要/保活/健康检查），每个服务进程只启动一次
+def start_background_workers():
+    """导入模块不会启动任何线程：基准脚本、测试与调试重载器的监视进程都只导入模块。
+
+    服务进程在收到第一个 HTTP 请求或 Socket.IO 连接时自动调用，无论以何种方式部署。
+    """
+    global background_workers_started
+    with background_workers_lock:
+        if background_workers_started:
+            return
+        background_workers_started = True
+    cleanup_stale_upload_temps()
+    # 后台持久化线程，并在进程退出时刷盘
+    socketio.start_background_task(persistence_worker)
+    atexit.register(flush_room_logs)
+    for _ in range(LINK_PREVIEW_WORKERS):
+        socketio.start_background_task(preview_worker)
+    socketio.start_background_task(summary_worker)
+    socketio.start_background_task(ai_health_worker)
+    socketio.start_background_task(ai_keepalive_worker)
+
+# 首个请求/连接时启动后台线程，避免持久化因部署方式不同而未启动
+@app.before_request
+def ensure_background_workers():
+    if not background_workers_started:
+        start_background_workers()
+
+@socketio.on('connect')
+def on_connect(auth=None):
+    ensure_background_workers()
+
 if __name__ == '__main__':
-    socketio.run(app, host='0.0.0.0', port=5000, debug=True)
+    debug = True
+    # 调试模式下由重载器启动的子进程提供服务，监视文件变化的父进程不启动后台线程
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_workers()
+    socketio.run(app, host='0.0.0.0', port=5000, debug=debug)
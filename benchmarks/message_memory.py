@@ -0,0 +1,90 @@
+"""房间消息常驻内存基准：比较旧版字典消息与 ChatMessage 每条消息占用的字节数
+
+用法：python benchmarks/message_memory.py [消息条数]
+
+消息按真实场景从 JSON 解码得到（Socket.IO 负载与日志重放都会产生新的字符串对象），
+混合用户消息、系统消息、AI 消息与文件消息。
+"""
+import gc
+import json
+import os
+import random
+import sys
+import tempfile
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# 导入 app 会在当前目录创建上传与日志目录，切换到临时目录避免污染仓库
+os.chdir(tempfile.mkdtemp(prefix='blackroom-bench-'))
+
+from app import ChatMessage  # noqa: E402
+
+
+def make_raw_messages(count, seed=42):
+    rng = random.Random(seed)
+    usernames = [f'用户{i}' for i in range(20)]
+    lines = []
+    for i in range(count):
+        username = rng.choice(usernames)
+        kind = rng.random()
+        message = {
+            'username': username,
+            'message': '消息内容 ' * rng.randint(1, 8) + str(i),
+            'type': 'user',
+            'link_preview': None,
+            'timestamp': '2024-05-01 12:00:00',
+            'message_id': f'room_{username}_{1714536000000 + i}'
+        }
+        if kind < 0.1:
+            message = {
+                'username': '系统',
+                'message': f'{username} 加入了房间',
+                'type': 'system',
+                'timestamp': '2024-05-01 12:00:00'
+            }
+        elif kind < 0.25:
+            message['type'] = 'ai'
+            message['username'] = 'AI助手'
+            del message['link_preview']
+        elif kind < 0.3:
+            message['type'] = 'file'
+            del message['link_preview']
+            message['file_info'] = {
+                'filename': 'photo.png',
+                'original_filename': 'photo.png',
+                'unique_filename': f'{1714536000000 + i}_photo.png',
+                'size': '1.2 MB',
+                'download_url': f'/download/{1714536000000 + i}_photo.png',
+                'file_type': 'image',
+                'is_cached': False
+            }
+        lines.append(json.dumps(message, ensure_ascii=False))
+    return lines
+
+
+def measure(build, lines):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    messages = [build(line) for line in lines]
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    assert len(messages) == len(lines)
+    return (after - before) / len(lines)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    lines = make_raw_messages(count)
+    legacy = measure(json.loads, lines)
+    compact = measure(lambda line: ChatMessage.from_dict(json.loads(line)), lines)
+    print(f'消息条数: {count}')
+    print(f'字典消息:    {legacy:8.1f} 字节/条')
+    print(f'ChatMessage: {compact:8.1f} 字节/条')
+    print(f'节省: {(1 - compact / legacy) * 100:.1f}%')
+
+
+if __name__ == '__main__':
+    main()